@@ -0,0 +1,104 @@
+import json
+import hashlib
+import datetime
+from flask import Blueprint, Response, current_app, g, jsonify, request, stream_with_context, url_for
+from werkzeug.utils import secure_filename
+
+import storage
+import thumbnails
+import metrics
+from database import api_token_user, write_notes_into_db, iter_notes, image_upload_records, iter_images
+
+# JSON API for sync clients, authenticated with "Authorization: Bearer <token>"
+# (tokens are created on the private page). Writes take whole batches and
+# store each batch in one transaction; lists are streamed row by row, so their
+# size doesn't matter.
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+
+def error(message, status):
+    return jsonify(error=message), status
+
+def bearer_user():
+    # The user of the request's API token, or None.
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return api_token_user(token.strip()) if scheme.lower() == "bearer" and token.strip() else None
+
+@api.before_request
+def authenticate():
+    g.api_user = bearer_user()
+    if g.api_user is None:
+        return error("missing or invalid API token", 401)
+
+def stream_array(rows, to_dict):
+    # "[", one object per row, "]": only the current row is ever in memory. The
+    # body is sent after the view returns, so the request context (url_for, g)
+    # is kept for the generator.
+    def generate():
+        yield "["
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps(to_dict(row))
+        yield "]"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+@api.route("/notes", methods=["GET"])
+def FUN_api_list_notes():
+    return stream_array(iter_notes(g.api_user),
+                        lambda x: {"note_id": x[0], "timestamp": x[1], "note": x[2]})
+
+@api.route("/notes", methods=["POST"])
+def FUN_api_write_notes():
+    # Body: {"notes": ["text", ...]} or {"notes": [{"note": "text"}, ...]}
+    body = request.get_json(silent=True)
+    notes = body.get("notes") if isinstance(body, dict) else None
+    if not isinstance(notes, list) or not notes:
+        return error('expected {"notes": [...]}', 400)
+    if len(notes) > current_app.config['API_MAX_BATCH']:
+        return error(f"at most {current_app.config['API_MAX_BATCH']} notes per request", 413)
+    notes = [x.get("note") if isinstance(x, dict) else x for x in notes]
+    if not all(isinstance(x, str) for x in notes):
+        return error("every note must be a string", 400)
+    return jsonify(note_ids=write_notes_into_db(g.api_user, notes)), 201
+
+@api.route("/images", methods=["GET"])
+def FUN_api_list_images():
+    return stream_array(iter_images(g.api_user),
+                        lambda x: {"uid": x[0], "timestamp": x[1], "name": x[2],
+                                   "url": url_for("FUN_image", image_uid=x[0])})
+
+@api.route("/images", methods=["POST"])
+def FUN_api_upload_images():
+    # multipart/form-data with one or more "file" parts; all of them are stored or none.
+    files = [x for x in request.files.getlist("file") if x.filename]
+    if not files:
+        return error('expected one or more "file" parts', 400)
+    if len(files) > current_app.config['API_MAX_BATCH']:
+        return error(f"at most {current_app.config['API_MAX_BATCH']} images per request", 413)
+    names = [secure_filename(x.filename) for x in files]
+    if not all("." in x and x.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS for x in names):
+        return error(f"allowed extensions: {', '.join(sorted(ALLOWED_EXTENSIONS))}", 400)
+
+    root = current_app.config['UPLOAD_FOLDER']
+    upload_time = str(datetime.datetime.now())
+    staged = [storage.stage(x.stream, root) for x in files]
+    try:
+        rows = []
+        for i, (name, blob) in enumerate(zip(names, staged)):
+            metrics.UPLOAD_BYTES.inc(blob.size)
+            image_uid = hashlib.sha1(f"{upload_time}{i}{name}".encode()).hexdigest()
+            rows.append((image_uid, g.api_user, name, upload_time, storage.blob_path(blob)))
+        # Same order as FUN_upload_image: rows first, then the blobs.
+        image_upload_records(rows)
+        for row, blob in zip(rows, staged):
+            storage.commit(root, blob, row[4])
+    finally:
+        for blob in staged:
+            blob.close()
+    for image_uid, _, name, _, path in rows:
+        thumbnails.submit(root, image_uid, name, path)
+    return jsonify(images=[{"uid": x[0], "name": x[2]} for x in rows]), 201
+
+def init_app(app):
+    app.register_blueprint(api)
@@ -1,12 +1,30 @@
 import os
+import base64
 import datetime
+import mimetypes
 import hashlib
-from flask import Flask, session, url_for, redirect, render_template, request, abort, flash
-from database import list_users, verify, delete_user_from_db, add_user
-from database import read_note_from_db, write_note_into_db, delete_note_from_db, match_user_id_with_note_id
-from database import image_upload_record, list_images_for_user, match_user_id_with_image_uid, delete_image_from_db
+from flask import Flask, Request, Response, session, url_for, redirect, render_template, request, abort, flash, jsonify, send_file
+from database import verify, user_exists, delete_user_from_db, add_user
+from database import write_note_into_db, delete_note_from_db, match_user_id_with_note_id
+from database import image_upload_record, match_user_id_with_image_uid, delete_image_from_db
+from database import get_image_file, pool_stats, list_recent_jobs, unreferenced_paths
+from database import list_users_page, count_users, read_notes_page, count_notes, list_images_page, count_images
+from database import search_notes, create_api_token, list_api_tokens, delete_api_token
 from werkzeug.utils import secure_filename
 from config import get_config
+from schema import upgrade as upgrade_schema, check_indexes
+import storage
+import thumbnails
+import jobs
+import metrics
+import logs
+import api
+import provisioning
+import export
+import assets
+import health
+import sessions
+import profiling
 
 
 
@@ -16,10 +34,34 @@ POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")   
 
+class UploadRequest(Request):
+    # Spool uploaded files into the image pool while hashing them, so storing an
+    # upload is a rename instead of another copy.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return storage.HashingTempFile(app.config['UPLOAD_FOLDER'])
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 #app.config.from_object('config')
 app.config.from_object(get_config())
 
+logs.init_app(app)
+metrics.init_app(app)
+api.init_app(app)
+assets.init_app(app)
+health.init_app(app)
+sessions.init_app(app)
+profiling.init_app(app)
+
+if app.config['AUTO_MIGRATE']:
+    upgrade_schema()
+else:
+    check_indexes()
+
+# Picks up jobs left over from before a restart.
+if app.config['JOB_WORKER_ENABLED']:
+    jobs.start_worker()
+
 
 
 @app.errorhandler(401)
@@ -54,33 +96,141 @@ def FUN_root():
 def FUN_public():
     return render_template("public_page.html")
 
+# Keyset pagination: a cursor is the sort key of the last row of the previous page.
+def page_size():
+    try:
+        per_page = int(request.args.get("per_page", app.config['PAGE_SIZE']))
+    except ValueError:
+        per_page = app.config['PAGE_SIZE']
+    return max(1, min(per_page, app.config['MAX_PAGE_SIZE']))
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode("\x1f".join(values).encode()).decode()
+
+def decode_cursor(cursor, parts):
+    # A missing or mangled cursor just means "first page".
+    if not cursor:
+        return None
+    try:
+        values = base64.urlsafe_b64decode(cursor.encode()).decode().split("\x1f")
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return values if len(values) == parts else None
+
+def split_page(rows, per_page, cursor_of):
+    # Pages are fetched with one extra row to know whether there is a next page.
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return rows, encode_cursor(*cursor_of(rows[-1]))
+    return rows, None
+
 @app.route("/private/")
 def FUN_private():
     if "current_user" in session.keys():
-        notes_list = read_note_from_db(session['current_user'])
+        per_page = page_size()
+        notes_list, notes_next = split_page(read_notes_page(session['current_user'], decode_cursor(request.args.get("notes_before"), 2), per_page + 1),
+                                            per_page, lambda x: (x[1], x[0]))
         notes_table = zip([x[0] for x in notes_list],\
                           [x[1] for x in notes_list],\
                           [x[2] for x in notes_list],\
                           ["/delete_note/" + x[0] for x in notes_list])
 
-        images_list = list_images_for_user(session['current_user'])
+        images_list, images_next = split_page(list_images_page(session['current_user'], decode_cursor(request.args.get("images_before"), 2), per_page + 1),
+                                              per_page, lambda x: (x[1], x[0]))
         images_table = zip([x[0] for x in images_list],\
                           [x[1] for x in images_list],\
                           [x[2] for x in images_list],\
+                          [x[3] is not None for x in images_list],\
                           ["/delete_image/" + x[0] for x in images_list])
 
-        return render_template("private_page.html", notes = notes_table, images = images_table)
+        return render_template("private_page.html", notes = notes_table, images = images_table,
+                               notes_count = count_notes(session['current_user']), notes_next = notes_next,
+                               images_count = count_images(session['current_user']), images_next = images_next,
+                               api_tokens = list_api_tokens(session['current_user']))
+    else:
+        return abort(401)
+
+@app.route("/api_token", methods = ["POST"])
+def FUN_create_api_token():
+    if "current_user" in session.keys():
+        # Shown once; only its hash is stored.
+        flash("New API token (copy it now, it won't be shown again): " + create_api_token(session['current_user']), category='success')
+        return(redirect(url_for("FUN_private")))
+    else:
+        return abort(401)
+
+@app.route("/delete_api_token/<token_hash>", methods = ["GET"])
+def FUN_delete_api_token(token_hash):
+    if "current_user" in session.keys():
+        delete_api_token(session['current_user'], token_hash)
+        return(redirect(url_for("FUN_private")))
+    else:
+        return abort(401)
+
+@app.route("/export")
+def FUN_export():
+    if "current_user" in session.keys():
+        return export_response(session['current_user'])
+    else:
+        return abort(401)
+
+@app.route("/admin/export/<id>")
+def FUN_admin_export(id):
+    if session.get("current_user", None) == "ADMIN":
+        if not user_exists(id.upper()):
+            return abort(404)
+        return export_response(id.upper())
     else:
         return abort(401)
 
+def export_response(user):
+    # The zip is generated while it is sent, so there is no Content-Length.
+    return Response(export.stream_user_archive(user, app.config['UPLOAD_FOLDER']), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename={secure_filename(user)}-export.zip"})
+
+@app.route("/search")
+def FUN_search():
+    if "current_user" in session.keys():
+        text = request.args.get("q", "").strip()
+        per_page = page_size()
+        try:
+            page = max(1, int(request.args.get("page", 1)))
+        except ValueError:
+            page = 1
+        # Ranked results can't be paged by keyset; offsets are fine for the few pages people read.
+        results = search_notes(session['current_user'], text, per_page + 1, (page - 1) * per_page) if text else []
+        return render_template("search.html", q = text, results = results[:per_page], page = page,
+                               has_next = len(results) > per_page)
+    else:
+        return abort(401)
+
+def render_admin_page(**kwargs):
+    per_page = page_size()
+    after = request.args.get("after")
+    try:
+        start = max(1, int(request.args.get("start", 1)))
+    except ValueError:
+        start = 1
+    user_list, users_next = split_page(list_users_page(after, per_page + 1), per_page, lambda x: (x,))
+    user_table = zip(range(start, start + len(user_list)),\
+                    user_list,\
+                    [x + y for x,y in zip(["/delete_user/"] * len(user_list), user_list)])
+    next_url = url_for("FUN_admin", after=user_list[-1], start=start + len(user_list), per_page=request.args.get("per_page")) if users_next else None
+    return render_template("admin.html", users = user_table, users_count = count_users(),
+                           users_next_url = next_url, paginated = after is not None,
+                           jobs = list_recent_jobs(), **kwargs)
+
 @app.route("/admin/")
 def FUN_admin():
     if session.get("current_user", None) == "ADMIN":
-        user_list = list_users()
-        user_table = zip(range(1, len(user_list)+1),\
-                        user_list,\
-                        [x + y for x,y in zip(["/delete_user/"] * len(user_list), user_list)])
-        return render_template("admin.html", users = user_table)
+        return render_admin_page()
+    else:
+        return abort(401)
+
+@app.route("/admin/db_pool")
+def FUN_admin_db_pool():
+    if session.get("current_user", None) == "ADMIN":
+        return jsonify(pool_stats())
     else:
         return abort(401)
 
@@ -92,14 +242,18 @@ def FUN_admin():
 @app.route("/write_note", methods = ["POST"])
 def FUN_write_note():
     text_to_write = request.form.get("text_note_to_take")
-    write_note_into_db(session['current_user'], text_to_write)
+    note_id = write_note_into_db(session['current_user'], text_to_write)
+    sessions.remember(session['current_user'], "note", note_id)
 
     return(redirect(url_for("FUN_private")))
 
 @app.route("/delete_note/<note_id>", methods = ["GET"])
 def FUN_delete_note(note_id):
-    if session.get("current_user", None) == match_user_id_with_note_id(note_id): # Ensure the current user is NOT operating on other users' note.
+    if sessions.owns(session.get("current_user", None), "note", note_id, match_user_id_with_note_id): # Ensure the current user is NOT operating on other users' note.
         delete_note_from_db(note_id)
+        sessions.forget(session['current_user'], "note", note_id)
+    elif "current_user" in session and match_user_id_with_note_id(note_id) is None: # deleted already, e.g. by a second click
+        return(redirect(url_for("FUN_private")))
     else:
         return abort(401)
     return(redirect(url_for("FUN_private")))
@@ -127,22 +281,80 @@ def FUN_upload_image():
             filename = secure_filename(file.filename)
             upload_time = str(datetime.datetime.now())
             image_uid = hashlib.sha1((upload_time + filename).encode()).hexdigest()
-            # Save the image into UPLOAD_FOLDER
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], image_uid + "-" + filename))
-            # Record this uploading in database
-            image_upload_record(image_uid, session['current_user'], filename, upload_time)
+            staged = storage.stage(file.stream, app.config['UPLOAD_FOLDER'])
+            metrics.UPLOAD_BYTES.inc(staged.size)
+            try:
+                path = storage.blob_path(staged)
+                # Record this uploading in database, then move the content into the pool (no-op for duplicates)
+                image_upload_record(image_uid, session['current_user'], filename, upload_time, path)
+                storage.commit(app.config['UPLOAD_FOLDER'], staged, path)
+                sessions.remember(session['current_user'], "image", image_uid)
+            finally:
+                staged.close()
+            # Thumbnail and preview are generated in the background
+            thumbnails.submit(app.config['UPLOAD_FOLDER'], image_uid, filename, path)
             return(redirect(url_for("FUN_private")))
 
     return(redirect(url_for("FUN_private")))
 
+@app.route("/image/<image_uid>", methods = ["GET"])
+def FUN_image(image_uid):
+    image = get_image_file(image_uid)
+    if image is None:
+        return abort(404)
+    owner, name, path, thumb_path, medium_path = image
+    # Ensure the current user (logged in, or calling with an API token) is NOT viewing other users' image.
+    if (session.get("current_user", None) or api.bearer_user()) != owner:
+        return abort(401)
+
+    # An uid always points to the same bytes, so the blob name (the content hash) is a strong ETag
+    # and the response can be cached for as long as the browser likes.
+    etag = storage.blob_key(image_uid, path)
+    variant = request.args.get("variant")
+    if variant is not None:
+        path = {"thumb": thumb_path, "medium": medium_path}.get(variant)
+        if path is None: # unknown variant, or not generated yet
+            return abort(404)
+        name = path
+        etag = os.path.basename(path)
+    if request.if_none_match.contains(etag):
+        rv = app.response_class(status=304)
+    elif app.config['IMAGE_ACCEL_REDIRECT_PREFIX']:
+        # Let the fronting nginx read the file from disk (X-Accel-Redirect).
+        rv = app.response_class(mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream")
+        rv.headers['X-Accel-Redirect'] = app.config['IMAGE_ACCEL_REDIRECT_PREFIX'] + (path or storage.legacy_path(image_uid, name))
+    else:
+        full_path = os.path.abspath(storage.absolute_path(app.config['UPLOAD_FOLDER'], path or storage.legacy_path(image_uid, name)))
+        try:
+            # send_file goes through wsgi.file_wrapper, which gunicorn serves with sendfile().
+            rv = send_file(full_path, mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+                           add_etags=False, cache_timeout=app.config['IMAGE_CACHE_MAX_AGE'])
+        except FileNotFoundError:
+            return abort(404)
+    rv.set_etag(etag)
+    rv.headers['Cache-Control'] = app.config['IMAGE_CACHE_CONTROL']
+    if rv.status_code == 200 and rv.direct_passthrough:
+        # Handles If-Range and Range (206) against the file we are sending.
+        rv.make_conditional(request, accept_ranges=True, complete_length=int(rv.headers['Content-Length']))
+    return rv
+
 @app.route("/delete_image/<image_uid>", methods = ["GET"])
 def FUN_delete_image(image_uid):
-    if session.get("current_user", None) == match_user_id_with_image_uid(image_uid): # Ensure the current user is NOT operating on other users' note.
+    if sessions.owns(session.get("current_user", None), "image", image_uid, match_user_id_with_image_uid): # Ensure the current user is NOT operating on other users' note.
         # delete the corresponding record in database
-        delete_image_from_db(image_uid)
-        # delete the corresponding image file from image pool
-        image_to_delete_from_pool = [y for y in [x for x in os.listdir(app.config['UPLOAD_FOLDER'])] if y.split("-", 1)[0] == image_uid][0]
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], image_to_delete_from_pool))
+        deleted = delete_image_from_db(image_uid)
+        sessions.forget(session['current_user'], "image", image_uid)
+        if deleted is None: # deleted by a concurrent request since the ownership check
+            return(redirect(url_for("FUN_private")))
+        name, path, references_left = deleted
+        # delete the image file from image pool once no other upload shares it
+        if path is None: # legacy file, never shared
+            storage.remove(app.config['UPLOAD_FOLDER'], storage.legacy_path(image_uid, name))
+            storage.remove_variants(app.config['UPLOAD_FOLDER'], image_uid)
+        elif references_left == 0: # counted again under the blob's lock, a duplicate may be arriving
+            storage.remove_unreferenced(app.config['UPLOAD_FOLDER'], path, unreferenced_paths)
+    elif "current_user" in session and match_user_id_with_image_uid(image_uid) is None: # deleted already, e.g. by a second click
+        return(redirect(url_for("FUN_private")))
     else:
         return abort(401)
     return(redirect(url_for("FUN_private")))
@@ -155,7 +367,8 @@ def FUN_delete_image(image_uid):
 @app.route("/login", methods = ["POST"])
 def FUN_login():
     id_submitted = request.form.get("id").upper()
-    if (id_submitted in list_users()) and verify(id_submitted, request.form.get("pw")):
+    if verify(id_submitted, request.form.get("pw")):
+        session.regenerate() # a new session id at every login
         session['current_user'] = id_submitted
     
     return(redirect(url_for("FUN_root")))
@@ -163,7 +376,7 @@ def FUN_login():
 
 @app.route("/logout/")
 def FUN_logout():
-    print(f"👋 Logging out {session.get('current_user')}")
+    app.logger.info("Logging out %s", session.get('current_user'))
     session.pop("current_user", None)
     return redirect(url_for("FUN_root"))
 
@@ -178,13 +391,11 @@ def FUN_delete_user(id):
         if id == "ADMIN": # ADMIN account can't be deleted.
             return abort(403)
 
-        # [1] Delete this user's images in image pool
-        images_to_remove = [x[0] for x in list_images_for_user(id)]
-        for f in images_to_remove:
-            image_to_delete_from_pool = [y for y in [x for x in os.listdir(app.config['UPLOAD_FOLDER'])] if y.split("-", 1)[0] == f][0]
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], image_to_delete_from_pool))
-        # [2] Delele the records in database files
-        delete_user_from_db(id)
+        # Rows go in one transaction; the image files are removed by a queued job.
+        if delete_user_from_db(id) is not None:
+            jobs.notify()
+        # Their sessions are gone with the user; drop the cached ones too.
+        sessions.revoke_user(app, id)
         return(redirect(url_for("FUN_admin")))
     else:
         return abort(401)
@@ -193,24 +404,40 @@ def FUN_delete_user(id):
 def FUN_add_user():
     if session.get("current_user", None) == "ADMIN": # only Admin should be able to add user.
         # before we add the user, we need to ensure this is doesn't exsit in database. We also need to ensure the id is valid.
-        if request.form.get('id').upper() in list_users():
-            user_list = list_users()
-            user_table = zip(range(1, len(user_list)+1),\
-                            user_list,\
-                            [x + y for x,y in zip(["/delete_user/"] * len(user_list), user_list)])
-            return(render_template("admin.html", id_to_add_is_duplicated = True, users = user_table))
-        if " " in request.form.get('id') or "'" in request.form.get('id'):
-            user_list = list_users()
-            user_table = zip(range(1, len(user_list)+1),\
-                            user_list,\
-                            [x + y for x,y in zip(["/delete_user/"] * len(user_list), user_list)])
-            return(render_template("admin.html", id_to_add_is_invalid = True, users = user_table))
+        if user_exists(request.form.get('id').upper()):
+            return render_admin_page(id_to_add_is_duplicated = True)
+        if provisioning.invalid_user_id(request.form.get('id')):
+            return render_admin_page(id_to_add_is_invalid = True)
         else:
             add_user(request.form.get('id'), request.form.get('pw'))
             return(redirect(url_for("FUN_admin")))
     else:
         return abort(401)
 
+@app.route("/admin/import_users", methods = ["POST"])
+def FUN_import_users():
+    if session.get("current_user", None) == "ADMIN":
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            flash('No selected file', category='danger')
+            return(redirect(url_for("FUN_admin")))
+        # The upload is spooled to disk by UploadRequest and read back line by line.
+        imported, rejected, errors = provisioning.import_users(provisioning.decode_lines(file.stream))
+        file.close()
+        flash(f"Imported {imported} users, rejected {rejected}." +
+              "".join(f" Line {line}: {reason}." for line, reason in errors), category='warning' if rejected else 'success')
+        return(redirect(url_for("FUN_admin")))
+    else:
+        return abort(401)
+
+@app.route("/admin/export_users")
+def FUN_export_users():
+    if session.get("current_user", None) == "ADMIN":
+        return Response(provisioning.export_users(), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=users.csv"})
+    else:
+        return abort(401)
+
 
 
 
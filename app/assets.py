@@ -0,0 +1,103 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import mimetypes
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip copies are built
+    brotli = None
+
+# Static assets are fingerprinted at build time (python assets.py build, run in
+# the Dockerfile): every file in static/ is copied to static/_build/ with a hash
+# of its content in the name, text files also as .gz and .br, and a manifest
+# maps the original names to the fingerprinted ones. url_for('static', ...)
+# then returns the fingerprinted URL, which never changes its content and can
+# be cached forever. Without a build, static files are served as before.
+
+BUILD_DIR = "_build"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+def build(static_folder):
+    out_dir = os.path.join(static_folder, BUILD_DIR)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        dirnames[:] = [x for x in dirnames if x != BUILD_DIR]
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                data = f.read()
+            stem, ext = os.path.splitext(name)
+            fingerprinted = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            target = os.path.join(out_dir, fingerprinted)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            if ext in COMPRESSIBLE:
+                # mtime=0 keeps the output identical between builds.
+                with open(target + ".gz", "wb") as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + ".br", "wb") as f:
+                        f.write(brotli.compress(data, quality=11))
+            manifest[name] = fingerprinted
+    with open(os.path.join(out_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(app):
+    path = os.path.join(app.static_folder, BUILD_DIR, MANIFEST)
+    try:
+        with open(path) as f:
+            app.extensions["assets"] = json.load(f)
+    except FileNotFoundError:
+        app.extensions["assets"] = {}
+
+def _fingerprint(app):
+    def url_defaults(endpoint, values):
+        # url_for('static', filename='css/x.css') -> /static/_build/css/x.<hash>.css
+        if endpoint == "static" and values.get("filename") in app.extensions["assets"]:
+            values["filename"] = f"{BUILD_DIR}/{app.extensions['assets'][values['filename']]}"
+    return url_defaults
+
+def _send_static(app):
+    def send_static(filename):
+        if not filename.startswith(BUILD_DIR + "/"):
+            return app.send_static_file(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encodings = [("br", ".br"), ("gzip", ".gz")] if os.path.splitext(filename)[1] in COMPRESSIBLE else []
+        for encoding, suffix in encodings:
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(app.static_folder, filename + suffix)):
+                rv = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+                rv.headers["Content-Encoding"] = encoding
+                break
+        else:
+            rv = send_from_directory(app.static_folder, filename, mimetype=mimetype)
+        rv.headers["Cache-Control"] = IMMUTABLE
+        if encodings:
+            rv.vary.add("Accept-Encoding")
+        return rv
+    return send_static
+
+def init_app(app):
+    load_manifest(app)
+    app.url_defaults(_fingerprint(app))
+    app.view_functions["static"] = _send_static(app)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static asset build")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="fingerprint and precompress static/ into static/_build/")
+    build_parser.add_argument("--static", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("brotli is not installed, building gzip copies only")
+    print(f"Built {len(build(args.static))} assets")
@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import socket
+import struct
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+# Load test for the main routes. Seeds a scratch database and image pool,
+# starts the app under gunicorn exactly as the Docker image does, drives one
+# route at a time from concurrent clients and reports throughput, latency
+# percentiles and database queries per request (taken from /metrics).
+#
+#   python benchmark.py --users 50 --notes 200 --output bench.json
+#   python benchmark.py --compare bench.json --output bench-new.json
+#
+# With USE_POSTGRES=true the seed data goes into the configured PostgreSQL
+# database (users named BENCH*, replaced on every run), and the admin scenario
+# logs in with BENCH_ADMIN_PASSWORD instead of replacing the ADMIN account.
+# Otherwise everything goes into fresh SQLite files in a temporary directory.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+USE_POSTGRES = os.getenv("USE_POSTGRES", "false").lower() == "true"
+PASSWORD = "bench"
+ADMIN_PASSWORD = os.getenv("BENCH_ADMIN_PASSWORD") or (None if USE_POSTGRES else PASSWORD)
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet"]
+
+SCENARIOS = {
+    # name: (method, path, expected statuses, log in as ADMIN)
+    "login": ("POST", "/login", (302,), False),
+    "private": ("GET", "/private/", (200,), False),
+    "write_note": ("POST", "/write_note", (302,), False),
+    "upload_image": ("POST", "/upload_image", (302,), False),
+    "search": ("GET", "/search?q=alpha", (200,), False),
+    "admin": ("GET", "/admin/", (200,), True),
+}
+
+def png(width=32, height=32):
+    # A small random RGB PNG, so that every upload is a new blob.
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+def user_id(n):
+    return f"BENCH{n:05d}"
+
+def seed(users, notes, images):
+    # Runs inside the scratch directory: database.py opens database_file/ relative to it.
+    import io
+    import storage
+    from schema import upgrade
+    from config import get_config
+    from database import add_user, delete_user_from_db, get_connection, image_upload_record, close_pool
+    upgrade()
+    root = get_config().UPLOAD_FOLDER
+    os.makedirs(root, exist_ok=True)
+    # A PostgreSQL database keeps the BENCH* users of earlier runs, with their notes and images.
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT id FROM users WHERE id LIKE 'BENCH%';")
+        leftover = [x[0] for x in _c.fetchall()]
+    for id in leftover:
+        delete_user_from_db(id)
+    if not USE_POSTGRES:
+        add_user("ADMIN", ADMIN_PASSWORD)
+    start = datetime.datetime.now()
+    for n in range(users):
+        add_user(user_id(n), PASSWORD)
+        rows = []
+        for i in range(notes):
+            timestamp = str(start - datetime.timedelta(seconds=i))
+            rows.append((user_id(n), timestamp, " ".join(random.choices(WORDS, k=8)), f"{n:05d}{i:08d}".ljust(40, "0")))
+        with get_connection("notes") as _conn:
+            _conn.cursor().executemany('INSERT INTO notes ("user", timestamp, note, note_id) VALUES (%s, %s, %s, %s)' if USE_POSTGRES else
+                                       'INSERT INTO notes ("user", timestamp, note, note_id) VALUES (?, ?, ?, ?)', rows)
+            _conn.commit()
+        for i in range(images):
+            staged = storage.stage(io.BytesIO(png()), root)
+            try:
+                path = storage.blob_path(staged)
+                uid = staged.hexdigest()[:40]
+                image_upload_record(uid, user_id(n), f"seed{i}.png", str(start - datetime.timedelta(seconds=i)), path)
+                storage.commit(root, staged, path)
+            finally:
+                staged.close()
+    close_pool()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, port, workers):
+    env = dict(os.environ,
+               PYTHONPATH=APP_DIR,
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, "prometheus"),
+               JOB_WORKER_ENABLED="false",  # keep its polling out of the query counts
+               GUNICORN_MAX_REQUESTS="0",  # a recycled worker drops the connections it was serving
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    log = open(os.path.join(workdir, "gunicorn.log"), "wb")
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "python:gunicorn_conf",
+                               "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--log-level", "warning", "app:app"],
+                              cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"gunicorn exited, see {workdir}/gunicorn.log")
+        try:
+            Client(port).request("GET", "/")
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("gunicorn did not start within 30s")
+
+
+class Client:
+    """One virtual user: a keep-alive connection plus its session cookie."""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.cookie = None
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if content_type:
+            headers["Content-Type"] = content_type
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            self.conn.close()  # reconnects on the next request
+            raise
+        data = response.read()
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status, data
+
+    def login(self, user, password=PASSWORD):
+        body = urllib.parse.urlencode({"id": user, "pw": password})
+        return self.request("POST", "/login", body, "application/x-www-form-urlencoded")
+
+
+def request_body(scenario, user):
+    if scenario == "login":
+        return urllib.parse.urlencode({"id": user, "pw": PASSWORD}), "application/x-www-form-urlencoded"
+    if scenario == "write_note":
+        return urllib.parse.urlencode({"text_note_to_take": " ".join(random.choices(WORDS, k=8))}), "application/x-www-form-urlencoded"
+    if scenario == "upload_image":
+        boundary = "benchboundary" + os.urandom(8).hex()
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"bench.png\"\r\n"
+                f"Content-Type: image/png\r\n\r\n").encode() + png() + f"\r\n--{boundary}--\r\n".encode()
+        return body, f"multipart/form-data; boundary={boundary}"
+    return None, None
+
+def query_count(port):
+    # Sum of db_query_duration_seconds_count over all database.py functions.
+    status, data = Client(port).request("GET", "/metrics")
+    total = 0.0
+    for line in data.decode().splitlines():
+        if line.startswith("db_query_duration_seconds_count"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list.
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))]
+
+def run_scenario(port, scenario, users, concurrency, duration, warmup):
+    method, path, expected, as_admin = SCENARIOS[scenario]
+    latencies, errors, lock = [], [0], threading.Lock()
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+    queries = [None]
+
+    def worker(n):
+        user = "ADMIN" if as_admin else user_id(n % users)
+        client = Client(port)
+        client.login(user, ADMIN_PASSWORD if as_admin else PASSWORD)
+        mine, my_errors = [], 0
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            body, content_type = request_body(scenario, user)
+            start = time.perf_counter()
+            try:
+                status, _ = client.request(method, path, body, content_type)
+                ok = status in expected
+            except (OSError, http.client.HTTPException):
+                ok = False
+            elapsed = time.perf_counter() - start
+            if now >= measure_from:
+                mine.append(elapsed)
+                my_errors += not ok
+        with lock:
+            latencies.extend(mine)
+            errors[0] += my_errors
+
+    def count_at_start():
+        time.sleep(max(0, measure_from - time.monotonic()))
+        queries[0] = query_count(port)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    counter = threading.Thread(target=count_at_start)
+    for t in threads + [counter]:
+        t.start()
+    for t in threads + [counter]:
+        t.join()
+    # Requests that were in flight when the warm-up ended make this approximate.
+    db_queries = query_count(port) - queries[0]
+
+    latencies.sort()
+    ms = lambda x: None if x is None else round(x * 1000, 2)
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "db_queries_per_request": round(db_queries / len(latencies), 2) if latencies else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _cell(value):
+    return "-" if value is None else value
+
+def print_results(results, baseline=None):
+    print(f"{'scenario':<14}{'req':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>7}")
+    for name, r in results.items():
+        line = (f"{name:<14}{r['requests']:>8}{r['errors']:>6}{r['throughput_rps']:>9}{_cell(r['p50_ms']):>9}"
+                f"{_cell(r['p95_ms']):>9}{_cell(r['p99_ms']):>9}{_cell(r['db_queries_per_request']):>7}")
+        old = (baseline or {}).get(name)
+        if old and old.get("throughput_rps") and old.get("p95_ms") and r["p95_ms"]:
+            line += (f"   rps {100 * (r['throughput_rps'] / old['throughput_rps'] - 1):+.0f}%"
+                     f", p95 {100 * (r['p95_ms'] / old['p95_ms'] - 1):+.0f}%")
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app under gunicorn")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--notes", type=int, default=100, help="notes per user")
+    parser.add_argument("--images", type=int, default=5, help="images per user")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the generated data")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sys.path.insert(0, APP_DIR)  # seed() imports the app modules after leaving this directory
+    scenarios = [x for x in args.scenarios.split(",") if x]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if "admin" in scenarios and ADMIN_PASSWORD is None:
+        print("Skipping the admin scenario: set BENCH_ADMIN_PASSWORD to run it against PostgreSQL")
+        scenarios.remove("admin")
+    baseline = json.load(open(args.compare))["results"] if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix="flask-bench-")
+    os.makedirs(os.path.join(workdir, "database_file"))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        print(f"Seeding {args.users} users with {args.notes} notes and {args.images} images each into {workdir}")
+        seed(args.users, args.notes, args.images)
+        port = free_port()
+        server = start_server(workdir, port, args.workers)
+        try:
+            results = {}
+            for scenario in scenarios:
+                results[scenario] = run_scenario(port, scenario, args.users, args.concurrency, args.duration, args.warmup)
+                print(f"  {scenario}: {results[scenario]['throughput_rps']} req/s")
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results, baseline)
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "backend": "postgres" if USE_POSTGRES else "sqlite",
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "keep")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("cache")
+
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    A `ttl` or `maxsize` of 0 disables the cache (every lookup is a miss).
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryBackend:
+    """In-process stand-in for a shared backend, used in tests."""
+
+    def __init__(self):
+        self._data = {}  # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                self._data.pop(key, None)
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (None if ttl is None else time.monotonic() + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, (None, 0))[1]) + 1
+            self._data[key] = (None, str(value))
+            return value
+
+
+class RedisBackend:
+    """Shared backend on Redis, so that all workers and replicas see each other's invalidations."""
+
+    def __init__(self, url):
+        import redis  # optional dependency, only needed when CACHE_REDIS_URL is set
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=None if ttl is None else max(1, int(ttl)))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+
+class UserDataCache:
+    """Read-through cache of per-user query results.
+
+    Results live in a local TTLCache, one entry per user holding all of that
+    user's cached queries, and with a shared backend also in the backend as
+    JSON. Each user has a generation counter in the backend; invalidating
+    bumps it, which retires every entry of the old generation in every
+    process at once. Without a backend, other processes only notice a change
+    when their entries expire.
+
+    `counter` is an optional prometheus Counter labeled by cache and result.
+    """
+
+    def __init__(self, name, maxsize=1000, ttl=60.0, backend=None, counter=None):
+        self.name = name
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.backend = backend
+        self._epoch = 0  # bumped by every invalidation in this process
+        self._counter = counter
+        self.stats = {"local_hit": 0, "shared_hit": 0, "miss": 0}
+
+    @property
+    def enabled(self):
+        return self.local.enabled
+
+    def _count(self, result):
+        self.stats[result] += 1
+        if self._counter is not None:
+            self._counter.labels(self.name, result).inc()
+
+    def _generation(self, user):
+        if self.backend is None:
+            return "0"
+        try:
+            return self.backend.get(f"{self.name}:gen:{user}") or "0"
+        except Exception:
+            logger.warning("Cache backend unavailable", exc_info=True)
+            return None
+
+    def get_or_load(self, user, query, loader):
+        if not self.enabled:
+            return loader()
+        generation = self._generation(user)
+        if generation is None:  # backend down: its invalidations can't be seen, so skip the cache
+            return loader()
+        epoch = self._epoch
+        entry = self.local.get(user)
+        if entry is not None and entry[0] == generation and query in entry[1]:
+            self._count("local_hit")
+            return entry[1][query]
+
+        shared_key = f"{self.name}:{user}:{generation}:{query}"
+        value = None
+        if self.backend is not None:
+            try:
+                raw = self.backend.get(shared_key)
+                value = None if raw is None else json.loads(raw)
+            except Exception:
+                logger.warning("Cache backend unavailable", exc_info=True)
+        if value is not None:
+            self._count("shared_hit")
+        else:
+            self._count("miss")
+            value = loader()
+            if self.backend is not None:
+                try:
+                    self.backend.set(shared_key, json.dumps(value), self.local.ttl)
+                except Exception:
+                    logger.warning("Cache backend unavailable", exc_info=True)
+
+        # If an invalidation ran while we were loading, the value may already be outdated.
+        if self._epoch == epoch:
+            if entry is None or entry[0] != generation:
+                entry = (generation, {})
+                self.local.set(user, entry)
+            entry[1][query] = value
+        return value
+
+    def invalidate(self, user):
+        self._epoch += 1
+        self.local.delete(user)
+        if self.backend is not None:
+            try:
+                self.backend.incr(f"{self.name}:gen:{user}")
+            except Exception:
+                logger.warning("Could not invalidate %s in the cache backend", user, exc_info=True)
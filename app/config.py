@@ -4,6 +4,96 @@ class BaseConfig:
     SECRET_KEY = os.environ.get("SECRET_KEY", "defaultsecret")
     UPLOAD_FOLDER = "image_pool"
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    # Rows per page on /private/ and /admin/ (?per_page= may ask for up to MAX_PAGE_SIZE)
+    PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "50"))
+    MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "200"))
+    # Apply pending schema changes (schema.py) when the app starts.
+    AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "true").lower() == "true"
+
+    # Database connection pool (PostgreSQL). Keep DB_POOL_SIZE * gunicorn workers
+    # * max replicas below the server's max_connections.
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+    DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))
+    DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+    DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+    # Server-side prepared statements for the hot queries. Turn off behind a PgBouncer
+    # in transaction pooling mode, which does not keep them between transactions.
+    DB_PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "true").lower() == "true"
+    # SQLite page cache and memory map, per connection.
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+    # Cache of user lookups (login and admin checks), shared through CACHE_REDIS_URL like
+    # the private page cache below. Without Redis it is off unless USER_CACHE_TTL is set:
+    # other workers would keep accepting a deleted user or an old password. 0 disables it.
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL = float(os.environ["USER_CACHE_TTL"]) if os.environ.get("USER_CACHE_TTL") else None
+
+    # Read-through cache of the /private/ page queries, per user. 0 disables it. Writes
+    # invalidate it at once in the worker that made them; set CACHE_REDIS_URL (needs the
+    # redis package) to share entries and invalidations between workers and replicas.
+    # Without Redis the cache is off unless PRIVATE_CACHE_TTL is set: other workers would
+    # go on showing a page from before the user's last write.
+    PRIVATE_CACHE_SIZE = int(os.environ.get("PRIVATE_CACHE_SIZE", "1000"))
+    PRIVATE_CACHE_TTL = float(os.environ["PRIVATE_CACHE_TTL"]) if os.environ.get("PRIVATE_CACHE_TTL") else None
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "")
+
+    # Server-side sessions (sessions.py): "database" (the sessions table) or "kv" (Redis at
+    # CACHE_REDIS_URL; without it an in-process store that only works with one worker).
+    # Sessions read recently can be cached for SESSION_CACHE_TTL seconds per worker (off by
+    # default: a logout or a consumed flash on one worker doesn't reach the others' copies),
+    # and the notes and images a user was found to own for OWNERSHIP_CACHE_TTL. 0 disables either.
+    SESSION_STORE = os.environ.get("SESSION_STORE", "database")
+    SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+    SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "0"))
+    OWNERSHIP_CACHE_TTL = float(os.environ.get("OWNERSHIP_CACHE_TTL", "300"))
+
+    # /image/<uid> responses never change, so they may be cached for a long time. Keep them
+    # "private": they are only visible to their owner and must not land in shared caches.
+    IMAGE_CACHE_MAX_AGE = int(os.environ.get("IMAGE_CACHE_MAX_AGE", str(365 * 24 * 3600)))
+    IMAGE_CACHE_CONTROL = os.environ.get("IMAGE_CACHE_CONTROL", f"private, max-age={IMAGE_CACHE_MAX_AGE}, immutable")
+    # Set to an nginx internal location (e.g. "/_image_pool/") to offload file transfer with X-Accel-Redirect.
+    IMAGE_ACCEL_REDIRECT_PREFIX = os.environ.get("IMAGE_ACCEL_REDIRECT_PREFIX", "")
+
+    # Background generation of resized image variants (thumbnails.py). THUMBNAIL_WORKERS = 0
+    # generates them inline during the upload request instead.
+    THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+    THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", "200"))
+    MEDIUM_WIDTH = int(os.environ.get("MEDIUM_WIDTH", "800"))
+    VARIANT_FORMAT = os.environ.get("VARIANT_FORMAT", "WEBP")  # WEBP, JPEG or PNG
+    VARIANT_QUALITY = int(os.environ.get("VARIANT_QUALITY", "80"))
+
+    # Structured logging (logs.py). LOG_SAMPLING keeps a share of DEBUG records per logger,
+    # e.g. "database=0.01".
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json or text
+    LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "")
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+    # Largest batch accepted by one POST to the JSON API (api.py).
+    API_MAX_BATCH = int(os.environ.get("API_MAX_BATCH", "10000"))
+
+    # Durable background jobs (jobs.py), e.g. removing a deleted user's files. Set
+    # JOB_WORKER_ENABLED to false when a separate "python jobs.py work" process runs them.
+    JOB_WORKER_ENABLED = os.environ.get("JOB_WORKER_ENABLED", "true").lower() == "true"
+    JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "30"))
+    JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "60"))
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+    JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", "300"))
+
+    # How long /readyz reuses its last result, so probes from several sources
+    # don't each hit the database.
+    READY_CACHE_TTL = float(os.environ.get("READY_CACHE_TTL", "2"))
+
+    # Request profiling (profiling.py), off by default. Sampled requests (a share of
+    # PROFILE_SAMPLE_RATE, plus those sending "X-Profile: <PROFILE_TOKEN>") are written
+    # to PROFILE_DIR as pstats dumps and span reports.
+    PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "false").lower() == "true"
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+    PROFILE_REPEATED_QUERY_THRESHOLD = int(os.environ.get("PROFILE_REPEATED_QUERY_THRESHOLD", "5"))
 
 def get_config():
     return BaseConfig
@@ -1,11 +1,33 @@
+import io
 import os
+import re
+import csv
+import hmac
+import json
+import time
 import hashlib
+import secrets
+import logging
 import datetime
+import functools
+import threading
+from config import get_config
+from db_pool import ConnectionPool, ThreadLocalConnections
+from cache import UserDataCache, RedisBackend
+from metrics import timed_query, CACHE_LOOKUPS
+import profiling
 
 USE_POSTGRES = os.getenv("USE_POSTGRES", "false").lower() == "true"
 
 if USE_POSTGRES:
     import psycopg2
+    import psycopg2.extensions
+
+    class _Connection(psycopg2.extensions.connection):
+        # Remembers which statements were prepared on this server session.
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
 else:
     import sqlite3
 
@@ -13,60 +35,245 @@ user_db_file_location = "database_file/users.db"
 note_db_file_location = "database_file/notes.db"
 image_db_file_location = "database_file/images.db"
 
+logger = logging.getLogger("database")
+
+_config = get_config()
+_pool = None
+_pool_lock = threading.Lock()
+
+def _cache_backend():
+    if not _config.CACHE_REDIS_URL:
+        return None
+    try:
+        return RedisBackend(_config.CACHE_REDIS_URL)
+    except ImportError:
+        logger.warning("CACHE_REDIS_URL is set but the redis package is not installed; not sharing the cache")
+        return None
+
+def _shared_cache_ttl(configured, default, backend):
+    # Invalidations only reach the other workers through a shared backend; without
+    # one they would serve stale data, so the cache defaults to off.
+    if configured is not None:
+        return configured
+    return default if backend is not None else 0.0
+
+# Results of the per-user reads behind /private/. Every write to a user's notes or
+# images calls _private_cache.invalidate(user).
+_private_backend = _cache_backend()
+_private_cache = UserDataCache("private", maxsize=_config.PRIVATE_CACHE_SIZE, ttl=_shared_cache_ttl(_config.PRIVATE_CACHE_TTL, 10.0, _private_backend),
+                               backend=_private_backend, counter=CACHE_LOOKUPS)
+
+# id -> password hash (None for unknown ids). add_user and delete_user_from_db
+# invalidate the id, in every worker through the shared backend.
+_user_cache = UserDataCache("users", maxsize=_config.USER_CACHE_SIZE, ttl=_shared_cache_ttl(_config.USER_CACHE_TTL, 30.0, _private_backend),
+                            backend=_private_backend, counter=CACHE_LOOKUPS)
+
+# sha256 of an API token -> its user (None for unknown tokens). Revoking the token
+# or deleting its user invalidates it, like _user_cache.
+_token_cache = UserDataCache("tokens", maxsize=_config.USER_CACHE_SIZE, ttl=_shared_cache_ttl(_config.USER_CACHE_TTL, 30.0, _private_backend),
+                             backend=_private_backend, counter=CACHE_LOOKUPS)
+
+def _cached_per_user(func):
+    # For read functions whose first argument is the user id. Rows come back as
+    # lists rather than tuples when they were cached in the shared backend.
+    @functools.wraps(func)
+    def wrapper(user, *args, **kwargs):
+        query = json.dumps([func.__name__, args, kwargs], sort_keys=True)
+        return _private_cache.get_or_load(user.upper(), query, lambda: func(user, *args, **kwargs))
+    return wrapper
+
+def _connect_postgres():
+    logger.info("Opening new PostgreSQL connection")
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT", "5432"),
+        connect_timeout=_config.DB_CONNECT_TIMEOUT,
+        connection_factory=_Connection
+    )
+
+def _connect_sqlite(db_type):
+    logger.info("Opening new SQLite connection for %s", db_type)
+    # Each thread only ever uses its own connection, the flag just lets
+    # close_pool() shut them down from whichever thread calls it.
+    conn = sqlite3.connect(f"database_file/{db_type}.db", check_same_thread=False)
+    # WAL lets readers run while another connection writes. With it, synchronous=NORMAL
+    # only syncs at checkpoints: a power loss may drop the last commits but never
+    # corrupts the file. mmap_size and cache_size (negative means KiB) keep hot pages
+    # in memory instead of going through read() for every page.
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA mmap_size={_config.SQLITE_MMAP_SIZE};")
+    conn.execute(f"PRAGMA cache_size=-{_config.SQLITE_CACHE_SIZE_KB};")
+    return conn
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if USE_POSTGRES:
+                    _pool = ConnectionPool(_connect_postgres,
+                                           size=_config.DB_POOL_SIZE,
+                                           timeout=_config.DB_POOL_TIMEOUT,
+                                           max_lifetime=_config.DB_POOL_MAX_LIFETIME,
+                                           health_check_interval=_config.DB_POOL_HEALTHCHECK_INTERVAL)
+                else:
+                    _pool = ThreadLocalConnections(_connect_sqlite)
+    return _pool
+
 def get_connection(db_type):
-    print(f"📡 Connecting to {'PostgreSQL' if USE_POSTGRES else 'SQLite'} for {db_type}")
-    if USE_POSTGRES:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB"),
-            user=os.getenv("POSTGRES_USER"),
-            password=os.getenv("POSTGRES_PASSWORD"),
-            host=os.getenv("POSTGRES_HOST"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
+    # Connections are borrowed from the pool; close() (or leaving a `with` block)
+    # returns them instead of closing the underlying socket/file.
+    pool = _get_pool()
+    trace = profiling.current()
+    if trace is None:
+        return pool.acquire() if USE_POSTGRES else pool.acquire(db_type)
+    # A profiled request (profiling.py): time the checkout and every query.
+    start = time.perf_counter()
+    conn = pool.acquire() if USE_POSTGRES else pool.acquire(db_type)
+    trace.add("connect", db_type, start, time.perf_counter() - start)
+    return profiling.TracedConnection(conn, trace)
+
+# Hot queries, run as server-side prepared statements on PostgreSQL so that they are
+# parsed and planned once per connection rather than on every call (sqlite3 already
+# caches the statements of each connection). Written with %s placeholders.
+_HOT_QUERIES = {
+    "lookup_user": "SELECT pw FROM users WHERE id = %s",
+    "note_owner": 'SELECT "user" FROM notes WHERE note_id = %s',
+    "image_owner": "SELECT owner FROM images WHERE uid = %s",
+    "image_file": "SELECT owner, name, path, thumb_path, medium_path FROM images WHERE uid = %s",
+    "notes_first_page": 'SELECT note_id, timestamp, note FROM notes WHERE "user" = %s ORDER BY timestamp DESC, note_id DESC LIMIT %s',
+    "images_first_page": "SELECT uid, timestamp, name, thumb_path FROM images WHERE owner = %s ORDER BY timestamp DESC, uid DESC LIMIT %s",
+    "count_notes": 'SELECT COUNT(*) FROM notes WHERE "user" = %s',
+    "count_images": "SELECT COUNT(*) FROM images WHERE owner = %s",
+}
+
+def _numbered(sql):
+    # "%s" placeholders -> "$1", "$2", ... as PREPARE expects them.
+    counter = iter(range(1, sql.count("%s") + 1))
+    return re.sub("%s", lambda _: f"${next(counter)}", sql)
+
+def _execute_hot(_conn, _c, name, params):
+    sql = _HOT_QUERIES[name]
+    if not USE_POSTGRES:
+        _c.execute(sql.replace("%s", "?"), params)
+    elif not _config.DB_PREPARED_STATEMENTS:
+        _c.execute(sql, params)
     else:
-        conn = sqlite3.connect(f"database_file/{db_type}.db")
-    print("✅ DB connection established")
-    return conn
+        if name not in _conn.prepared:
+            _c.execute(f"PREPARE {name} AS {_numbered(sql)};")
+            _conn.prepared.add(name)
+        _c.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))});", params)
+
+def pool_stats():
+    return _get_pool().stats()
 
+def ping(db_type="users"):
+    # One round trip, for the readiness check (opens the connection if needed).
+    with get_connection(db_type) as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT 1;")
+        _c.fetchone()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+@timed_query
 def list_users():
-    print("🔍 Running list_users()")
-    _conn = get_connection("users")
-    _c = _conn.cursor()
-    _c.execute("SELECT id FROM users;")
-    result = [x[0] for x in _c.fetchall()]
-    _conn.close()
-    print(f"✅ list_users(): {result}")
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT id FROM users;")
+        result = [x[0] for x in _c.fetchall()]
+    logger.debug("list_users() returned %d users", len(result))
     return result
 
+@timed_query
+def list_users_page(after_id=None, limit=50):
+    # Keyset pagination over the primary key: cost depends on the page size, not the table size.
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        if after_id is None:
+            _c.execute("SELECT id FROM users ORDER BY id LIMIT %s;" if USE_POSTGRES else "SELECT id FROM users ORDER BY id LIMIT ?;", (limit,))
+        else:
+            _c.execute("SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s;" if USE_POSTGRES else "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?;", (after_id, limit))
+        result = [x[0] for x in _c.fetchall()]
+    return result
+
+@timed_query
+def count_users():
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT COUNT(*) FROM users;")
+        result = _c.fetchone()[0]
+    return result
+
+def _lookup_user(id):
+    # One indexed primary-key lookup gives us both existence and the password hash.
+    def load():
+        with get_connection("users") as _conn:
+            _c = _conn.cursor()
+            _execute_hot(_conn, _c, "lookup_user", (id,))
+            row = _c.fetchone()
+        return row[0] if row else None
+    return _user_cache.get_or_load(id, "pw", load)
+
+@timed_query
+def user_exists(id):
+    return _lookup_user(id) is not None
+
+@timed_query
 def verify(id, pw):
-    print(f"🔐 Verifying user: {id}")
-    _conn = get_connection("users")
-    _c = _conn.cursor()
-    _c.execute("SELECT pw FROM users WHERE id = %s;" if USE_POSTGRES else "SELECT pw FROM users WHERE id = ?;", (id,))
-    result = _c.fetchone()[0] == hashlib.sha256(pw.encode()).hexdigest()
-    _conn.close()
-    print(f"✅ Password verified: {result}")
+    pw_hash = _lookup_user(id)
+    result = pw_hash is not None and hmac.compare_digest(pw_hash, hashlib.sha256(pw.encode()).hexdigest())
+    logger.debug("Password check for %s: %s", id, result)
     return result
 
+def _attach_all(_conn):
+    # SQLite keeps every table in its own file. Attaching notes.db and images.db to
+    # the users connection lets one transaction cover all of them. In WAL mode each
+    # file commits atomically on its own, so a crash in the middle of the commit
+    # itself may apply it to only some of the files.
+    attached = {x[1] for x in _conn.execute("PRAGMA database_list;").fetchall()}
+    for db_type in ("notes", "images"):
+        if db_type not in attached:
+            _conn.execute(f"ATTACH DATABASE 'database_file/{db_type}.db' AS {db_type};")
+
+def _qualified(db_type):
+    return db_type if USE_POSTGRES else f"{db_type}.{db_type}"
+
+@timed_query
 def delete_user_from_db(id):
-    print(f"🗑️ Deleting user: {id}")
-    _conn = get_connection("users")
-    _c = _conn.cursor()
-    _c.execute("DELETE FROM users WHERE id = %s;" if USE_POSTGRES else "DELETE FROM users WHERE id = ?;", (id,))
-    _conn.commit()
-    _conn.close()
-
-    _conn = get_connection("notes")
-    _c = _conn.cursor()
-    _c.execute("DELETE FROM notes WHERE user = %s;" if USE_POSTGRES else "DELETE FROM notes WHERE user = ?;", (id,))
-    _conn.commit()
-    _conn.close()
-
-    _conn = get_connection("images")
-    _c = _conn.cursor()
-    _c.execute("DELETE FROM images WHERE owner = %s;" if USE_POSTGRES else "DELETE FROM images WHERE owner = ?;", (id,))
-    _conn.commit()
-    _conn.close()
+    # Deletes the user, their notes, image rows, API tokens and sessions in one transaction and, in
+    # the same transaction, queues a job that removes the image files afterwards.
+    # Returns the id of that job (None when the user had no images).
+    logger.info("Deleting user %s", id)
+    with get_connection("users") as _conn:
+        if not USE_POSTGRES:
+            _attach_all(_conn)
+        _c = _conn.cursor()
+        _c.execute(f"SELECT uid, name, path FROM {_qualified('images')} WHERE owner = %s;" if USE_POSTGRES else f"SELECT uid, name, path FROM {_qualified('images')} WHERE owner = ?;", (id,))
+        items = [{"path": path} if path else {"uid": uid, "name": name} for uid, name, path in _c.fetchall()]
+        _c.execute("DELETE FROM users WHERE id = %s;" if USE_POSTGRES else "DELETE FROM users WHERE id = ?;", (id,))
+        _c.execute(f'DELETE FROM {_qualified("notes")} WHERE "user" = %s;' if USE_POSTGRES else f'DELETE FROM {_qualified("notes")} WHERE "user" = ?;', (id,))
+        _c.execute(f"DELETE FROM {_qualified('images')} WHERE owner = %s;" if USE_POSTGRES else f"DELETE FROM {_qualified('images')} WHERE owner = ?;", (id,))
+        _c.execute('SELECT token_hash FROM api_tokens WHERE "user" = %s;' if USE_POSTGRES else 'SELECT token_hash FROM api_tokens WHERE "user" = ?;', (id.upper(),))
+        token_hashes = [x[0] for x in _c.fetchall()]
+        _c.execute('DELETE FROM api_tokens WHERE "user" = %s;' if USE_POSTGRES else 'DELETE FROM api_tokens WHERE "user" = ?;', (id.upper(),))
+        _c.execute('DELETE FROM sessions WHERE "user" = %s;' if USE_POSTGRES else 'DELETE FROM sessions WHERE "user" = ?;', (id.upper(),))
+        job_id = _enqueue_job(_c, "delete_files", {"user": id, "items": items}, len(items)) if items else None
+        _conn.commit()
+    _user_cache.invalidate(id)
+    _private_cache.invalidate(id.upper())
+    for token_hash in token_hashes:
+        _token_cache.invalidate(token_hash)
+    return job_id
 
 #def add_user(id, pw):
  #   print(f"➕ Adding user: {id}")
@@ -79,93 +286,482 @@ def delete_user_from_db(id):
 
 
 def add_user(id, pw):
-    print(f"➕ Adding user: {id}")
-    _conn = get_connection("users")
-    _c = _conn.cursor()
+    logger.info("Adding user %s", id)
+    upsert_users([(id, pw)])
+
+@timed_query
+def upsert_users(id_pw_pairs):
+    # Creates the users, or resets the password of those that exist, in one transaction.
+    rows = [(id.upper(), hashlib.sha256(pw.encode()).hexdigest()) for id, pw in id_pw_pairs]
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.executemany("INSERT INTO users (id, pw) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET pw = EXCLUDED.pw;" if USE_POSTGRES else "INSERT INTO users (id, pw) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET pw = excluded.pw;",
+                       rows)
+        _conn.commit()
+    for id, _ in rows:
+        _user_cache.invalidate(id)
+
+def iter_users(batch_size=1000):
+    # All user ids in order, read through a server-side cursor like iter_notes.
+    with get_connection("users") as _conn:
+        _c = _conn.cursor("iter_users") if USE_POSTGRES else _conn.cursor()
+        _c.execute("SELECT id FROM users ORDER BY id;")
+        while True:
+            rows = _c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+        _c.close()
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+@timed_query
+def create_api_token(id):
+    # Only the hash is stored; the token itself is shown to the user once.
+    token = secrets.token_urlsafe(32)
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('INSERT INTO api_tokens (token_hash, "user", created) VALUES (%s, %s, %s);' if USE_POSTGRES else 'INSERT INTO api_tokens (token_hash, "user", created) VALUES (?, ?, ?);',
+                   (_token_hash(token), id.upper(), str(datetime.datetime.now())))
+        _conn.commit()
+    _private_cache.invalidate(id.upper())
+    return token
+
+@_cached_per_user
+@timed_query
+def list_api_tokens(id):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('SELECT token_hash, created FROM api_tokens WHERE "user" = %s ORDER BY created;' if USE_POSTGRES else 'SELECT token_hash, created FROM api_tokens WHERE "user" = ? ORDER BY created;', (id.upper(),))
+        result = _c.fetchall()
+    return result
+
+@timed_query
+def delete_api_token(id, token_hash):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('DELETE FROM api_tokens WHERE token_hash = %s AND "user" = %s;' if USE_POSTGRES else 'DELETE FROM api_tokens WHERE token_hash = ? AND "user" = ?;', (token_hash, id.upper()))
+        _conn.commit()
+    _token_cache.invalidate(token_hash)
+    _private_cache.invalidate(id.upper())
+
+@timed_query
+def api_token_user(token):
+    # The user an API token belongs to, or None.
+    token_hash = _token_hash(token)
+    def load():
+        with get_connection("users") as _conn:
+            _c = _conn.cursor()
+            _c.execute('SELECT "user" FROM api_tokens WHERE token_hash = %s;' if USE_POSTGRES else 'SELECT "user" FROM api_tokens WHERE token_hash = ?;', (token_hash,))
+            row = _c.fetchone()
+        return row[0] if row else None
+    return _token_cache.get_or_load(token_hash, "user", load)
 
-    # 💡 Ensure test doesn't break due to duplicates
-    _c.execute("DELETE FROM users WHERE id = %s;" if USE_POSTGRES else "DELETE FROM users WHERE id = ?;", (id.upper(),))
-    _conn.commit()
 
-    _c.execute("INSERT INTO users values(%s, %s)" if USE_POSTGRES else "INSERT INTO users values(?, ?)",
-               (id.upper(), hashlib.sha256(pw.encode()).hexdigest()))
-    _conn.commit()
-    _conn.close()
+@timed_query
+def load_session(sid_hash):
+    # (user, data) of an unexpired session, or None.
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('SELECT "user", data FROM sessions WHERE sid_hash = %s AND expires > %s;' if USE_POSTGRES else 'SELECT "user", data FROM sessions WHERE sid_hash = ? AND expires > ?;',
+                   (sid_hash, time.time()))
+        row = _c.fetchone()
+    return tuple(row) if row else None
 
+@timed_query
+def save_session(sid_hash, user, data, expires):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('INSERT INTO sessions (sid_hash, "user", data, expires) VALUES (%s, %s, %s, %s) ON CONFLICT (sid_hash) DO UPDATE SET "user" = EXCLUDED."user", data = EXCLUDED.data, expires = EXCLUDED.expires;' if USE_POSTGRES else 'INSERT INTO sessions (sid_hash, "user", data, expires) VALUES (?, ?, ?, ?) ON CONFLICT (sid_hash) DO UPDATE SET "user" = excluded."user", data = excluded.data, expires = excluded.expires;',
+                   (sid_hash, user, data, expires))
+        _conn.commit()
 
+@timed_query
+def delete_session(sid_hash):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("DELETE FROM sessions WHERE sid_hash = %s;" if USE_POSTGRES else "DELETE FROM sessions WHERE sid_hash = ?;", (sid_hash,))
+        _conn.commit()
+
+@timed_query
+def delete_user_sessions(id):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute('DELETE FROM sessions WHERE "user" = %s;' if USE_POSTGRES else 'DELETE FROM sessions WHERE "user" = ?;', (id.upper(),))
+        _conn.commit()
+
+@timed_query
+def delete_expired_sessions():
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("DELETE FROM sessions WHERE expires <= %s;" if USE_POSTGRES else "DELETE FROM sessions WHERE expires <= ?;", (time.time(),))
+        count = _c.rowcount
+        _conn.commit()
+    return count
+
+
+@timed_query
 def read_note_from_db(id):
-    print(f"📓 Reading notes for: {id}")
-    _conn = get_connection("notes")
-    _c = _conn.cursor()
-    _c.execute("SELECT note_id, timestamp, note FROM notes WHERE user = %s;" if USE_POSTGRES else "SELECT note_id, timestamp, note FROM notes WHERE user = ?;", (id.upper(),))
-    result = _c.fetchall()
-    _conn.commit()
-    _conn.close()
+    logger.debug("Reading notes for %s", id)
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _c.execute('SELECT note_id, timestamp, note FROM notes WHERE "user" = %s;' if USE_POSTGRES else 'SELECT note_id, timestamp, note FROM notes WHERE "user" = ?;', (id.upper(),))
+        result = _c.fetchall()
     return result
 
-def match_user_id_with_note_id(note_id):
-    _conn = get_connection("notes")
-    _c = _conn.cursor()
-    _c.execute("SELECT user FROM notes WHERE note_id = %s;" if USE_POSTGRES else "SELECT user FROM notes WHERE note_id = ?;", (note_id,))
-    result = _c.fetchone()[0]
-    _conn.commit()
-    _conn.close()
+@_cached_per_user
+@timed_query
+def read_notes_page(id, before=None, limit=50):
+    # Newest first. `before` is the (timestamp, note_id) of the last note of the previous
+    # page; the row-value comparison is served by the notes("user", timestamp, note_id) index.
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        if before is None:
+            _execute_hot(_conn, _c, "notes_first_page", (id.upper(), limit))
+        else:
+            _c.execute('SELECT note_id, timestamp, note FROM notes WHERE "user" = %s AND (timestamp, note_id) < (%s, %s) ORDER BY timestamp DESC, note_id DESC LIMIT %s;' if USE_POSTGRES else 'SELECT note_id, timestamp, note FROM notes WHERE "user" = ? AND (timestamp, note_id) < (?, ?) ORDER BY timestamp DESC, note_id DESC LIMIT ?;',
+                       (id.upper(), before[0], before[1], limit))
+        result = _c.fetchall()
+    return result
+
+@_cached_per_user
+@timed_query
+def count_notes(id):
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _execute_hot(_conn, _c, "count_notes", (id.upper(),))
+        result = _c.fetchone()[0]
+    return result
+
+@timed_query
+def search_notes(id, text, limit=50, offset=0):
+    # Ranked full-text search over the notes of one user, best match first. Terms
+    # are ANDed; see schema.py for the indexes behind it.
+    if USE_POSTGRES:
+        with get_connection("notes") as _conn:
+            _c = _conn.cursor()
+            _c.execute("SELECT note_id, timestamp, note FROM notes, plainto_tsquery('simple', %s) query "
+                       'WHERE "user" = %s AND note_tsv @@ query ORDER BY ts_rank_cd(note_tsv, query) DESC, timestamp DESC LIMIT %s OFFSET %s;',
+                       (text, id.upper(), limit, offset))
+            result = _c.fetchall()
+        return result
+    # Quote every word, so input can never be read as FTS5 query syntax.
+    terms = re.findall(r"\w+", text)
+    if not terms:
+        return []
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _c.execute('SELECT notes.note_id, notes.timestamp, notes.note FROM notes_fts JOIN notes ON notes.rowid = notes_fts.rowid '
+                   'WHERE notes_fts MATCH ? AND notes."user" = ? ORDER BY notes_fts.rank, notes.timestamp DESC LIMIT ? OFFSET ?;',
+                   (" ".join(f'"{x}"' for x in terms), id.upper(), limit, offset))
+        result = _c.fetchall()
     return result
 
+@timed_query
+def match_user_id_with_note_id(note_id):
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _execute_hot(_conn, _c, "note_owner", (note_id,))
+        row = _c.fetchone()
+    return row[0] if row else None  # None when there is no such note, e.g. deleted already
+
+@timed_query
 def write_note_into_db(id, note_to_write):
-    print(f"📝 Writing note for user: {id}")
-    _conn = get_connection("notes")
-    _c = _conn.cursor()
-    current_timestamp = str(datetime.datetime.now())
-    note_id = hashlib.sha1((id.upper() + current_timestamp).encode()).hexdigest()
-    _c.execute("INSERT INTO notes values(%s, %s, %s, %s)" if USE_POSTGRES else "INSERT INTO notes values(?, ?, ?, ?)",
-               (id.upper(), current_timestamp, note_to_write, note_id))
-    _conn.commit()
-    _conn.close()
+    logger.debug("Writing note for %s", id)
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        current_timestamp = str(datetime.datetime.now())
+        note_id = hashlib.sha1((id.upper() + current_timestamp).encode()).hexdigest()
+        _c.execute("INSERT INTO notes values(%s, %s, %s, %s)" if USE_POSTGRES else "INSERT INTO notes values(?, ?, ?, ?)",
+                   (id.upper(), current_timestamp, note_to_write, note_id))
+        _conn.commit()
+    _private_cache.invalidate(id.upper())
+    return note_id
+
+@timed_query
+def write_notes_into_db(id, notes_to_write):
+    # Batch version of write_note_into_db: one transaction, COPY on PostgreSQL and
+    # executemany on SQLite. Notes get increasing timestamps, so they keep their order.
+    # Returns the new note ids.
+    logger.debug("Writing %d notes for %s", len(notes_to_write), id)
+    start = datetime.datetime.now()
+    rows = []
+    for i, note in enumerate(notes_to_write):
+        timestamp = str(start + datetime.timedelta(microseconds=i))
+        rows.append((id.upper(), timestamp, note, hashlib.sha1((id.upper() + timestamp).encode()).hexdigest()))
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        if USE_POSTGRES:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            _c.copy_expert('COPY notes ("user", timestamp, note, note_id) FROM STDIN WITH (FORMAT csv);', buffer)
+        else:
+            _c.executemany('INSERT INTO notes ("user", timestamp, note, note_id) VALUES (?, ?, ?, ?);', rows)
+        _conn.commit()
+    _private_cache.invalidate(id.upper())
+    return [x[3] for x in rows]
 
+def iter_notes(id, batch_size=500):
+    # Streams all notes of a user, oldest first, without loading them all: PostgreSQL
+    # uses a server-side (named) cursor, SQLite steps through its result set.
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor("iter_notes") if USE_POSTGRES else _conn.cursor()
+        _c.execute('SELECT note_id, timestamp, note FROM notes WHERE "user" = %s ORDER BY timestamp, note_id;' if USE_POSTGRES else 'SELECT note_id, timestamp, note FROM notes WHERE "user" = ? ORDER BY timestamp, note_id;', (id.upper(),))
+        while True:
+            rows = _c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        _c.close()
+
+@timed_query
 def delete_note_from_db(note_id):
-    print(f"❌ Deleting note: {note_id}")
-    _conn = get_connection("notes")
-    _c = _conn.cursor()
-    _c.execute("DELETE FROM notes WHERE note_id = %s;" if USE_POSTGRES else "DELETE FROM notes WHERE note_id = ?;", (note_id,))
-    _conn.commit()
-    _conn.close()
-
-def image_upload_record(uid, owner, image_name, timestamp):
-    print(f"📸 Uploading image for user: {owner}")
-    _conn = get_connection("images")
-    _c = _conn.cursor()
-    _c.execute("INSERT INTO images VALUES (%s, %s, %s, %s)" if USE_POSTGRES else "INSERT INTO images VALUES (?, ?, ?, ?)",
-               (uid, owner, image_name, timestamp))
-    _conn.commit()
-    _conn.close()
+    logger.debug("Deleting note %s", note_id)
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _c.execute('SELECT "user" FROM notes WHERE note_id = %s;' if USE_POSTGRES else 'SELECT "user" FROM notes WHERE note_id = ?;', (note_id,))
+        owner = _c.fetchone()
+        _c.execute("DELETE FROM notes WHERE note_id = %s;" if USE_POSTGRES else "DELETE FROM notes WHERE note_id = ?;", (note_id,))
+        _conn.commit()
+    if owner is not None:
+        _private_cache.invalidate(owner[0].upper())
+
+@timed_query
+def image_upload_record(uid, owner, image_name, timestamp, path=None):
+    logger.debug("Recording image upload for %s", owner)
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.execute("INSERT INTO images (uid, owner, name, timestamp, path) VALUES (%s, %s, %s, %s, %s)" if USE_POSTGRES else "INSERT INTO images (uid, owner, name, timestamp, path) VALUES (?, ?, ?, ?, ?)",
+                   (uid, owner, image_name, timestamp, path))
+        _conn.commit()
+    _private_cache.invalidate(owner.upper())
 
+@timed_query
+def image_upload_records(rows):
+    # Batch version of image_upload_record; rows are (uid, owner, name, timestamp, path).
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.executemany("INSERT INTO images (uid, owner, name, timestamp, path) VALUES (%s, %s, %s, %s, %s)" if USE_POSTGRES else "INSERT INTO images (uid, owner, name, timestamp, path) VALUES (?, ?, ?, ?, ?)",
+                       rows)
+        _conn.commit()
+    for owner in {x[1] for x in rows}:
+        _private_cache.invalidate(owner.upper())
+
+def iter_images(owner, batch_size=500):
+    # Same as iter_notes, for (uid, timestamp, name, path) of a user's images.
+    with get_connection("images") as _conn:
+        _c = _conn.cursor("iter_images") if USE_POSTGRES else _conn.cursor()
+        _c.execute("SELECT uid, timestamp, name, path FROM images WHERE owner = %s ORDER BY timestamp, uid;" if USE_POSTGRES else "SELECT uid, timestamp, name, path FROM images WHERE owner = ? ORDER BY timestamp, uid;", (owner,))
+        while True:
+            rows = _c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        _c.close()
+
+@_cached_per_user
+@timed_query
 def list_images_for_user(owner):
-    print(f"🖼️ Listing images for: {owner}")
-    _conn = get_connection("images")
-    _c = _conn.cursor()
-    _c.execute("SELECT uid, timestamp, name FROM images WHERE owner = %s" if USE_POSTGRES else "SELECT uid, timestamp, name FROM images WHERE owner = ?", (owner,))
-    result = _c.fetchall()
-    _conn.commit()
-    _conn.close()
+    logger.debug("Listing images for %s", owner)
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT uid, timestamp, name, thumb_path FROM images WHERE owner = %s" if USE_POSTGRES else "SELECT uid, timestamp, name, thumb_path FROM images WHERE owner = ?", (owner,))
+        result = _c.fetchall()
+    return result
+
+@_cached_per_user
+@timed_query
+def list_images_page(owner, before=None, limit=50):
+    # Same keyset scheme as read_notes_page, on images(owner, timestamp, uid).
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        if before is None:
+            _execute_hot(_conn, _c, "images_first_page", (owner, limit))
+        else:
+            _c.execute("SELECT uid, timestamp, name, thumb_path FROM images WHERE owner = %s AND (timestamp, uid) < (%s, %s) ORDER BY timestamp DESC, uid DESC LIMIT %s;" if USE_POSTGRES else "SELECT uid, timestamp, name, thumb_path FROM images WHERE owner = ? AND (timestamp, uid) < (?, ?) ORDER BY timestamp DESC, uid DESC LIMIT ?;",
+                       (owner, before[0], before[1], limit))
+        result = _c.fetchall()
     return result
 
+@_cached_per_user
+@timed_query
+def count_images(owner):
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _execute_hot(_conn, _c, "count_images", (owner,))
+        result = _c.fetchone()[0]
+    return result
+
+@timed_query
 def match_user_id_with_image_uid(image_uid):
-    _conn = get_connection("images")
-    _c = _conn.cursor()
-    _c.execute("SELECT owner FROM images WHERE uid = %s;" if USE_POSTGRES else "SELECT owner FROM images WHERE uid = ?;", (image_uid,))
-    result = _c.fetchone()[0]
-    _conn.commit()
-    _conn.close()
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _execute_hot(_conn, _c, "image_owner", (image_uid,))
+        row = _c.fetchone()
+    return row[0] if row else None  # None when there is no such image, e.g. deleted already
+
+@timed_query
+def get_image_file(image_uid):
+    # (owner, name, path, thumb_path, medium_path) of the stored file; path is NULL for rows
+    # from before the sharded layout, the variant paths until the thumbnails are generated.
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _execute_hot(_conn, _c, "image_file", (image_uid,))
+        result = _c.fetchone()
     return result
 
+@timed_query
+def set_image_paths(uid_path_pairs):
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.executemany("UPDATE images SET path = %s WHERE uid = %s;" if USE_POSTGRES else "UPDATE images SET path = ? WHERE uid = ?;",
+                       [(path, uid) for uid, path in uid_path_pairs])
+        _conn.commit()
+
+@timed_query
+def set_image_variants(image_uid, thumb_path, medium_path):
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.execute("UPDATE images SET thumb_path = %s, medium_path = %s WHERE uid = %s;" if USE_POSTGRES else "UPDATE images SET thumb_path = ?, medium_path = ? WHERE uid = ?;",
+                   (thumb_path, medium_path, image_uid))
+        _c.execute("SELECT owner FROM images WHERE uid = %s;" if USE_POSTGRES else "SELECT owner FROM images WHERE uid = ?;", (image_uid,))
+        owner = _c.fetchone()
+        _conn.commit()
+    if owner is not None:  # the private page shows the thumbnail once it exists
+        _private_cache.invalidate(owner[0].upper())
+
+@timed_query
+def list_images_without_variants(after_uid, limit):
+    # Keyset over uid so a backfill over a large table never re-reads rows.
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT uid, name, path FROM images WHERE thumb_path IS NULL AND uid > %s ORDER BY uid LIMIT %s;" if USE_POSTGRES else "SELECT uid, name, path FROM images WHERE thumb_path IS NULL AND uid > ? ORDER BY uid LIMIT ?;",
+                   (after_uid, limit))
+        result = _c.fetchall()
+    return result
+
+@timed_query
 def delete_image_from_db(image_uid):
-    print(f"🧹 Deleting image with UID: {image_uid}")
-    _conn = get_connection("images")
-    _c = _conn.cursor()
-    _c.execute("DELETE FROM images WHERE uid = %s;" if USE_POSTGRES else "DELETE FROM images WHERE uid = ?;", (image_uid,))
-    _conn.commit()
-    _conn.close()
+    # Returns (name, path, references left to the same blob) of the deleted row, or
+    # None when there is no such image.
+    logger.debug("Deleting image %s", image_uid)
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT name, path, owner FROM images WHERE uid = %s;" if USE_POSTGRES else "SELECT name, path, owner FROM images WHERE uid = ?;", (image_uid,))
+        row = _c.fetchone()
+        if row is None:  # deleted already
+            return None
+        name, path, owner = row
+        _c.execute("DELETE FROM images WHERE uid = %s;" if USE_POSTGRES else "DELETE FROM images WHERE uid = ?;", (image_uid,))
+        references_left = 0
+        if path is not None:
+            _c.execute("SELECT COUNT(*) FROM images WHERE path = %s;" if USE_POSTGRES else "SELECT COUNT(*) FROM images WHERE path = ?;", (path,))
+            references_left = _c.fetchone()[0]
+        _conn.commit()
+    _private_cache.invalidate(owner.upper())
+    return name, path, references_left
+
+@timed_query
+def unreferenced_paths(paths, batch_size=500):
+    # The subset of `paths` that no images row points to any more.
+    paths = list(set(paths))
+    referenced = set()
+    with get_connection("images") as _conn:
+        _c = _conn.cursor()
+        for i in range(0, len(paths), batch_size):
+            batch = paths[i:i + batch_size]
+            placeholders = ", ".join(["%s" if USE_POSTGRES else "?"] * len(batch))
+            _c.execute(f"SELECT DISTINCT path FROM images WHERE path IN ({placeholders});", batch)
+            referenced.update(x[0] for x in _c.fetchall())
+    return [x for x in paths if x not in referenced]
+
+# Background jobs (see jobs.py). A job moves pending -> running -> done, or back to
+# pending with a later run_after when it fails, until it runs out of attempts.
+
+def _enqueue_job(_c, kind, payload, total):
+    now = str(datetime.datetime.now())
+    params = (kind, json.dumps(payload), "pending", total, time.time(), now, now)
+    if USE_POSTGRES:
+        _c.execute("INSERT INTO jobs (kind, payload, status, total, run_after, created, updated) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;", params)
+        return _c.fetchone()[0]
+    _c.execute("INSERT INTO jobs (kind, payload, status, total, run_after, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?);", params)
+    return _c.lastrowid
+
+@timed_query
+def enqueue_job(kind, payload, total=0):
+    with get_connection("users") as _conn:
+        job_id = _enqueue_job(_conn.cursor(), kind, payload, total)
+        _conn.commit()
+    return job_id
+
+@timed_query
+def claim_job(stale_after):
+    # Takes the oldest runnable job, or a "running" one whose worker stopped
+    # heartbeating `stale_after` seconds ago. Returns (id, kind, payload, done) or None.
+    now = time.time()
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        if USE_POSTGRES:
+            _c.execute("UPDATE jobs SET status = 'running', locked_at = %s, attempts = attempts + 1, updated = %s WHERE id = ("
+                       "SELECT id FROM jobs WHERE (status = 'pending' AND run_after <= %s) OR (status = 'running' AND locked_at < %s) "
+                       "ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING id, kind, payload, done;",
+                       (now, str(datetime.datetime.now()), now, now - stale_after))
+            row = _c.fetchone()
+        else:
+            _c.execute("SELECT id FROM jobs WHERE (status = 'pending' AND run_after <= ?) OR (status = 'running' AND locked_at < ?) ORDER BY id LIMIT 1;",
+                       (now, now - stale_after))
+            row = _c.fetchone()
+            if row is not None:
+                # Only wins if no other worker claimed it in the meantime.
+                _c.execute("UPDATE jobs SET status = 'running', locked_at = ?, attempts = attempts + 1, updated = ? WHERE id = ? AND "
+                           "((status = 'pending' AND run_after <= ?) OR (status = 'running' AND locked_at < ?));",
+                           (now, str(datetime.datetime.now()), row[0], now, now - stale_after))
+                if _c.rowcount == 1:
+                    _c.execute("SELECT id, kind, payload, done FROM jobs WHERE id = ?;", (row[0],))
+                    row = _c.fetchone()
+                else:
+                    row = None
+        _conn.commit()
+    if row is None:
+        return None
+    return row[0], row[1], json.loads(row[2]), row[3]
+
+@timed_query
+def update_job_progress(job_id, done):
+    # Also serves as the heartbeat of a running job.
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("UPDATE jobs SET done = %s, locked_at = %s, updated = %s WHERE id = %s;" if USE_POSTGRES else "UPDATE jobs SET done = ?, locked_at = ?, updated = ? WHERE id = ?;",
+                   (done, time.time(), str(datetime.datetime.now()), job_id))
+        _conn.commit()
+
+@timed_query
+def finish_job(job_id):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("UPDATE jobs SET status = 'done', done = total, locked_at = NULL, last_error = NULL, updated = %s WHERE id = %s;" if USE_POSTGRES else "UPDATE jobs SET status = 'done', done = total, locked_at = NULL, last_error = NULL, updated = ? WHERE id = ?;",
+                   (str(datetime.datetime.now()), job_id))
+        _conn.commit()
+
+@timed_query
+def fail_job(job_id, error, retry_in, max_attempts):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("UPDATE jobs SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END, run_after = %s, locked_at = NULL, last_error = %s, updated = %s WHERE id = %s;" if USE_POSTGRES else "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, run_after = ?, locked_at = NULL, last_error = ?, updated = ? WHERE id = ?;",
+                   (max_attempts, time.time() + retry_in, error, str(datetime.datetime.now()), job_id))
+        _conn.commit()
+
+@timed_query
+def list_recent_jobs(limit=10):
+    with get_connection("users") as _conn:
+        _c = _conn.cursor()
+        _c.execute("SELECT id, kind, status, done, total, attempts, last_error, updated FROM jobs ORDER BY id DESC LIMIT %s;" if USE_POSTGRES else "SELECT id, kind, status, done, total, attempts, last_error, updated FROM jobs ORDER BY id DESC LIMIT ?;",
+                   (limit,))
+        result = _c.fetchall()
+    return result
 
 if __name__ == "__main__":
     print(list_users())
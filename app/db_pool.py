@@ -0,0 +1,267 @@
+import os
+import time
+import threading
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    # Thin proxy around a DB-API connection. close() hands the connection back
+    # to its pool instead of tearing it down, so existing callers keep working.
+    def __init__(self, release, conn):
+        self._release = release
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise AttributeError(name)
+        return getattr(self._conn, name)
+
+    def close(self, discard=False):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._release(conn, discard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _reset(conn):
+    # Return the connection to a clean state (no open transaction) before reuse.
+    if getattr(conn, "closed", 0):
+        return False
+    try:
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _ping(conn):
+    try:
+        _c = conn.cursor()
+        _c.execute("SELECT 1")
+        _c.fetchone()
+        _c.close()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool (used for PostgreSQL).
+
+    Connections idle for longer than `health_check_interval` are pinged before
+    being handed out, and connections older than `max_lifetime` are recycled.
+    """
+
+    def __init__(self, connect, size=5, timeout=10.0, max_lifetime=1800.0, health_check_interval=30.0):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._cond = threading.Condition()
+        self._init_state()
+
+    def _init_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._created = {}    # id(conn) -> created_at, for connections checked out
+        self._opened = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+        self._failed_health_checks = 0
+
+    def _check_pid(self):
+        # After a fork the inherited sockets belong to the parent: forget them
+        # without closing (closing would terminate the parent's sessions).
+        if self._pid != os.getpid():
+            self._init_state()
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime > 0 and now - created_at > self.max_lifetime
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        entry = None
+        with self._cond:
+            self._check_pid()
+            waited = False
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()  # LIFO keeps the warmest connections busy
+                    break
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"no database connection available after {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._checkouts += 1
+            if waited:
+                wait_time = time.monotonic() - start
+                self._waits += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+
+        try:
+            conn = None
+            now = time.monotonic()
+            if entry is not None:
+                conn, created_at, last_used = entry
+                if self._expired(created_at, now):
+                    self._recycled += 1
+                    _close_quietly(conn)
+                    conn = None
+                elif getattr(conn, "closed", 0) or \
+                        (now - last_used > self.health_check_interval and not _ping(conn)):
+                    self._failed_health_checks += 1
+                    _close_quietly(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+                created_at = time.monotonic()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        self._created[id(conn)] = created_at
+        return PooledConnection(self._release, conn)
+
+    def _release(self, conn, discard=False):
+        created_at = self._created.pop(id(conn), 0.0)
+        keep = not discard and _reset(conn)
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            now = time.monotonic()
+            if keep and self._expired(created_at, now):
+                self._recycled += 1
+                keep = False
+            if keep:
+                self._idle.append((conn, created_at, now))
+            else:
+                self._opened -= 1
+            self._cond.notify()
+        if not keep:
+            _close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "backend": "postgres",
+                "size": self.size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time_total, 6),
+                "wait_time_max": round(self._wait_time_max, 6),
+                "timeouts": self._timeouts,
+                "recycled": self._recycled,
+                "failed_health_checks": self._failed_health_checks,
+            }
+
+    def close(self):
+        with self._cond:
+            self._check_pid()  # in a forked child there is nothing of its own to close
+            idle, self._idle = self._idle, deque()
+            self._opened -= len(idle)
+        for conn, _, _ in idle:
+            _close_quietly(conn)
+
+
+class ThreadLocalConnections:
+    """Persistent per-thread connections (used for SQLite).
+
+    SQLite connections are cheap to keep but may not be shared across threads,
+    so every thread keeps one open connection per database file.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+        self._checkouts = 0
+        self._in_use = 0
+
+    def acquire(self, db_type):
+        conns = getattr(self._local, "conns", None)
+        if conns is None or getattr(self._local, "pid", None) != os.getpid():
+            conns = self._local.conns = {}
+            self._local.pid = os.getpid()
+        conn = conns.get(db_type)
+        if conn is None:
+            conn = conns[db_type] = self._connect(db_type)
+            with self._lock:
+                self._all.append(conn)
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+        return PooledConnection(lambda c, discard: self._release(db_type, c, discard), conn)
+
+    def _release(self, db_type, conn, discard=False):
+        with self._lock:
+            self._in_use -= 1
+        if conn.in_transaction:
+            conn.rollback()
+        if discard:
+            self._local.conns.pop(db_type, None)
+            with self._lock:
+                self._all.remove(conn)
+            _close_quietly(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "opened": len(self._all),
+                "in_use": self._in_use,
+                "idle": len(self._all) - self._in_use,
+                "checkouts": self._checkouts,
+                "waits": 0,
+                "wait_time_total": 0.0,
+                "wait_time_max": 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        # Connections inherited through fork() belong to the parent, only forget them.
+        if self._pid == os.getpid():
+            for conn in conns:
+                _close_quietly(conn)
+        self._local = threading.local()
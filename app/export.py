@@ -0,0 +1,71 @@
+import json
+import logging
+import zipfile
+
+import storage
+from database import iter_notes, iter_images
+
+# Streams everything a user owns as a zip archive that is built while it is
+# being sent: notes.ndjson (one note per line, read through a cursor) and the
+# original images, read from the pool in chunks. Only the current chunk is in
+# memory, however large the account is.
+
+logger = logging.getLogger("export")
+
+
+class _Pipe:
+    # Write-only file for zipfile; whatever was written is taken out by drain().
+    # Having no seek() or tell() makes zipfile write streaming (data descriptor) entries.
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_user_archive(user, root):
+    return (chunk for chunk in _archive_chunks(user, root) if chunk)
+
+def _archive_chunks(user, root):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("notes.ndjson", "w", force_zip64=True) as f:
+            for note_id, timestamp, note in iter_notes(user):
+                f.write((json.dumps({"note_id": note_id, "timestamp": timestamp, "note": note}) + "\n").encode())
+                yield pipe.drain()
+        yield pipe.drain()
+
+        for image_uid, timestamp, name, path in iter_images(user):
+            full_path = storage.absolute_path(root, path or storage.legacy_path(image_uid, name))
+            # Images are compressed already; store them as they are.
+            info = zipfile.ZipInfo(f"images/{image_uid}-{name}", date_time=_date_time(timestamp))
+            info.compress_type = zipfile.ZIP_STORED
+            try:
+                source = open(full_path, "rb")
+            except FileNotFoundError:
+                logger.warning("Image file missing from export: %s", full_path)
+                continue
+            with source, archive.open(info, "w", force_zip64=True) as f:
+                for chunk in iter(lambda: source.read(storage.CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain()  # the central directory
+
+def _date_time(timestamp):
+    # "2024-05-01 12:30:00.123456" -> the tuple zip headers store (zip dates start in 1980).
+    try:
+        date, _, time = timestamp.partition(" ")
+        parts = [int(x) for x in date.split("-")] + [int(float(x)) for x in time.split(":")]
+        return tuple(parts) if len(parts) == 6 and parts[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
+    except (AttributeError, ValueError):
+        return (1980, 1, 1, 0, 0, 0)
@@ -0,0 +1,119 @@
+import os
+import math
+import shutil
+
+# Loaded with `gunicorn -c python:gunicorn_conf app:app` (the image only ships
+# bytecode, which gunicorn can import as a module but not read as a file).
+#
+# Workers are sized from the container's cgroup limits rather than the host's
+# core count: the pods get half a CPU, and 4 sync workers on it only queue up
+# behind each other. The routes mostly wait on the database and the disk, so
+# each worker runs several threads (gthread) instead. Every setting can be
+# overridden through a GUNICORN_* variable; command line flags win over both.
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+WORKER_MEMORY_MB = int(os.environ.get("GUNICORN_WORKER_MEMORY_MB", "80"))
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def cpu_limit(root=CGROUP_ROOT):
+    # CPUs the container may use (e.g. 0.5), or None when it isn't limited.
+    quota = _read(os.path.join(root, "cpu.max"))  # cgroup v2: "<quota> <period>" or "max <period>"
+    if quota is not None:
+        quota, _, period = quota.partition(" ")
+    else:
+        quota, period = _read(os.path.join(root, "cpu", "cpu.cfs_quota_us")), _read(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    try:
+        return int(quota) / int(period) if int(quota) > 0 else None
+    except (TypeError, ValueError):
+        return None
+
+def memory_limit(root=CGROUP_ROOT):
+    # Bytes the container may use, or None when it isn't limited.
+    limit = _read(os.path.join(root, "memory.max")) or _read(os.path.join(root, "memory", "memory.limit_in_bytes"))
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return None
+    # cgroup v1 reports "unlimited" as a number close to 2**63.
+    return limit if limit < 2 ** 60 else None
+
+def default_workers(cpus, memory, worker_memory_mb=WORKER_MEMORY_MB):
+    # Two workers per CPU (but at least two, so that one can restart while the other
+    # serves), as many as fit in memory next to the master.
+    workers = max(2, math.ceil(2 * cpus))
+    if memory is not None:
+        workers = min(workers, memory // (worker_memory_mb * 2 ** 20) - 1)
+    return max(1, workers)
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS") or default_workers(cpu_limit() or _cpu_count(), memory_limit()))
+# gthread, or gevent (pip install gevent) for many slow clients.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# Keep threads <= DB_POOL_SIZE, or requests wait for a connection.
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "100"))  # gevent only
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+# Restart workers now and then to return fragmented memory; the jitter keeps
+# them from all restarting at once.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+# Import the app once in the master; the workers share its memory pages and start faster.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+# The heartbeat file; the container's overlay filesystem can stall it.
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+if preload_app:
+    import jobs
+    jobs.hold_worker()
+
+def on_starting(server):
+    # prometheus_client's multiprocess files must not survive a restart.
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+    server.log.info("%d %s workers, %d threads each", workers, worker_class, threads)
+
+def pre_fork(server, worker):
+    # Connections the master opened while loading the app (schema checks) are
+    # of no use to it afterwards.
+    if preload_app:
+        import database
+        database.close_pool()
+
+def post_fork(server, worker):
+    # What the master started while loading the app doesn't survive the fork:
+    # a new connection pool, log listener and job runner for this worker. Then
+    # warm up, so the first requests don't pay for compiling templates and
+    # connecting to the database.
+    import logs
+    import jobs
+    import health
+    import database
+    from config import get_config
+    config = get_config()
+    database.close_pool()
+    logs.configure_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_SAMPLING, config.LOG_QUEUE_SIZE)
+    if config.JOB_WORKER_ENABLED:
+        jobs.start_worker()
+    health.warm_up(server.app.wsgi())
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+import tempfile
+from flask import current_app, jsonify
+
+import models
+from database import ping
+
+# Probes for Kubernetes (see the deployments in k8s/):
+#   /healthz  the process answers; no I/O, so a slow database never gets pods killed
+#   /readyz   the database answers and UPLOAD_FOLDER is writable; until it does,
+#             the pod gets no traffic
+# Every worker warms up after it starts (gunicorn_conf.post_fork): templates are
+# compiled and the database connections opened before the first request needs them.
+
+logger = logging.getLogger("health")
+
+_warm_pid = None
+_ready = None  # (expires, status code, body), per process
+
+def warm_up(app):
+    # Returns whether everything is warm; failures are logged, never raised, and
+    # retried by the next /readyz.
+    global _warm_pid
+    if _warm_pid == os.getpid():
+        return True
+    start = time.monotonic()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    try:
+        for db_type in sorted({x.db_type for x in models.TABLES}):
+            ping(db_type)
+    except Exception:
+        logger.warning("Warm-up could not reach the database", exc_info=True)
+        return False
+    _warm_pid = os.getpid()
+    logger.info("Warmed up in %.3fs", time.monotonic() - start)
+    return True
+
+def _check_database():
+    ping()
+
+def _check_upload_folder():
+    with tempfile.TemporaryFile(dir=current_app.config['UPLOAD_FOLDER']):
+        pass
+
+CHECKS = {
+    "database": _check_database,
+    "upload_folder": _check_upload_folder,
+}
+
+def healthz():
+    return "ok", 200, {"Cache-Control": "no-store"}
+
+def readyz():
+    global _ready
+    now = time.monotonic()
+    if _ready is None or _ready[0] <= now:
+        results = {}
+        for name, check in CHECKS.items():
+            try:
+                check()
+                results[name] = "ok"
+            except Exception:
+                # Details go to the log only: the endpoint is unauthenticated.
+                logger.warning("Readiness check %s failed", name, exc_info=True)
+                results[name] = "failed"
+        ok = all(x == "ok" for x in results.values()) and warm_up(current_app)
+        _ready = (now + current_app.config['READY_CACHE_TTL'], 200 if ok else 503,
+                  {"status": "ok" if ok else "unavailable", "checks": results})
+    response = jsonify(_ready[2])
+    response.status_code = _ready[1]
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+def init_app(app):
+    app.add_url_rule("/healthz", "FUN_healthz", healthz)
+    app.add_url_rule("/readyz", "FUN_readyz", readyz)
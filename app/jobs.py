@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import argparse
+import threading
+
+import storage
+from config import get_config
+from database import claim_job, update_job_progress, finish_job, fail_job, unreferenced_paths
+
+# Durable background jobs, stored in the jobs table so they survive restarts.
+# Jobs are enqueued in the same transaction as the change they follow up on
+# (see delete_user_from_db), so work is never lost between the commit and the
+# cleanup. Any worker process may claim a job; one whose worker died is picked
+# up again once JOB_STALE_AFTER has passed. Handlers record their progress and
+# resume from it, and every step is idempotent, so running one twice is harmless.
+
+logger = logging.getLogger("jobs")
+
+_config = get_config()
+BATCH_SIZE = 100
+
+_worker = None
+_worker_pid = None
+_held_pid = None
+_worker_lock = threading.Lock()
+_wakeup = threading.Event()
+
+def _delete_files(job_id, payload, done):
+    # payload["items"]: {"path": blob} for content addressed files, {"uid", "name"} for legacy ones.
+    root = _config.UPLOAD_FOLDER
+    items = payload["items"]
+    while done < len(items):
+        batch = items[done:done + BATCH_SIZE]
+        # A blob may have been uploaded again by someone else; only drop unreferenced
+        # ones, checking each again under its lock before it goes.
+        for path in unreferenced_paths([x["path"] for x in batch if "path" in x]):
+            storage.remove_unreferenced(root, path, unreferenced_paths)
+        for item in batch:
+            if "path" not in item:
+                storage.remove(root, storage.legacy_path(item["uid"], item["name"]))
+                storage.remove_variants(root, item["uid"])
+        done += len(batch)
+        update_job_progress(job_id, done)
+
+HANDLERS = {
+    "delete_files": _delete_files,
+}
+
+def run_one():
+    # Claims and runs a single job. Returns False when there was nothing to do.
+    job = claim_job(_config.JOB_STALE_AFTER)
+    if job is None:
+        return False
+    job_id, kind, payload, done = job
+    try:
+        HANDLERS[kind](job_id, payload, done)
+    except Exception as e:
+        logger.warning("Job %s (%s) failed", job_id, kind, exc_info=True)
+        fail_job(job_id, str(e), _config.JOB_RETRY_DELAY, _config.JOB_MAX_ATTEMPTS)
+    else:
+        finish_job(job_id)
+        logger.info("Job %s (%s) done", job_id, kind)
+    return True
+
+def run_pending():
+    count = 0
+    while run_one():
+        count += 1
+    return count
+
+def _loop():
+    while True:
+        try:
+            run_pending()
+        except Exception:
+            logger.warning("Job worker error", exc_info=True)
+        _wakeup.wait(_config.JOB_POLL_INTERVAL)
+        _wakeup.clear()
+
+def hold_worker():
+    # Keeps start_worker() from starting a thread in this process, but not in the
+    # ones forked from it: the gunicorn master with preload_app only forks workers,
+    # and a thread there would be copied into every worker mid-way through its work.
+    global _held_pid
+    _held_pid = os.getpid()
+
+def start_worker():
+    global _worker, _worker_pid
+    with _worker_lock:
+        if _held_pid == os.getpid():
+            return
+        # Threads don't survive fork(), so every gunicorn worker starts its own.
+        if _worker is None or _worker_pid != os.getpid():
+            _worker = threading.Thread(target=_loop, name="jobs", daemon=True)
+            _worker.start()
+            _worker_pid = os.getpid()
+
+def notify():
+    # Runs newly enqueued jobs right away instead of at the next poll.
+    if _config.JOB_WORKER_ENABLED:
+        start_worker()
+        _wakeup.set()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background job worker")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("work", help="run pending jobs, then keep polling for new ones")
+    subparsers.add_parser("drain", help="run pending jobs and exit")
+    args = parser.parse_args()
+
+    from schema import upgrade
+    upgrade()
+    if args.command == "drain":
+        print(f"Ran {run_pending()} jobs")
+    else:
+        while True:
+            run_pending()
+            time.sleep(_config.JOB_POLL_INTERVAL)
@@ -0,0 +1,156 @@
+import os
+import sys
+import copy
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import contextvars
+import logging.handlers
+from flask import request
+
+# Logging for the app: request threads only put records on an in-memory queue
+# (QueueHandler); a background QueueListener thread formats them as JSON lines
+# and does the actual write. Debug calls that are switched off cost a level
+# check and nothing else, so hot paths log with logger.debug("... %s", arg)
+# instead of building strings up front.
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed with extra={...}.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            payload["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    # Runs in the emitting thread, where the request's context is still visible.
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of DEBUG records for the configured loggers.
+
+    `rates` maps a logger name (and its children) to the share of debug
+    records to keep, e.g. {"database": 0.01}.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+_plain = logging.Formatter()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # When the listener can't keep up, drop records instead of blocking requests.
+    dropped = 0
+
+    def prepare(self, record):
+        # The stock prepare() renders the traceback into msg and drops it; keep it
+        # in exc_text instead, so the listener's formatter puts it where it belongs
+        # ("exc" in JSON). Only the traceback objects stay behind in this thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _plain.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def parse_sampling(spec):
+    # "database=0.01,thumbnails=0.5" -> {"database": 0.01, "thumbnails": 0.5}
+    rates = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+_listener = None
+_configured_pid = None
+
+def configure_logging(level="INFO", fmt="json", sampling="", queue_size=10000, stream=None):
+    # Safe to call again; after a fork it restarts the listener thread, which
+    # does not survive into the child.
+    global _listener, _configured_pid
+    if _configured_pid == os.getpid():
+        return
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else
+                         logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter(parse_sampling(sampling)))
+
+    root = logging.getLogger()
+    for old in [h for h in root.handlers if isinstance(h, DroppingQueueHandler)]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+    _configured_pid = os.getpid()
+    atexit.register(_listener.stop)
+
+def _before_request():
+    request_id_var.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex)
+
+def _after_request(response):
+    if request_id_var.get():
+        response.headers["X-Request-ID"] = request_id_var.get()
+    return response
+
+def _teardown_request(exc):
+    request_id_var.set(None)
+
+def init_app(app):
+    configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'], app.config['LOG_SAMPLING'], app.config['LOG_QUEUE_SIZE'])
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,82 @@
+import os
+import time
+import functools
+from flask import g, request
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# With several gunicorn workers every process keeps its own counters. When
+# PROMETHEUS_MULTIPROC_DIR is set, prometheus_client writes them to mmap'ed
+# files in that directory and /metrics aggregates them across workers. The
+# directory must be empty when the server starts (see gunicorn.conf.py).
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+if MULTIPROCESS:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram("flask_request_duration_seconds", "Request latency per Flask endpoint",
+                            ["endpoint", "method"], buckets=LATENCY_BUCKETS)
+REQUEST_COUNT = Counter("flask_requests_total", "Requests per Flask endpoint and status code",
+                        ["endpoint", "method", "status"])
+IN_FLIGHT = Gauge("flask_requests_in_progress", "Requests currently being handled",
+                  multiprocess_mode="livesum")
+UPLOAD_BYTES = Counter("flask_upload_bytes_total", "Bytes received in image uploads")
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "Latency of database.py functions (its _count is the call count)",
+                             ["function"], buckets=LATENCY_BUCKETS)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "database.py calls that raised", ["function"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Read-through cache lookups by result (local_hit, shared_hit, miss)",
+                        ["cache", "result"])
+
+def timed_query(func):
+    # Decorator for the database.py functions.
+    latency = DB_QUERY_LATENCY.labels(func.__name__)
+    errors = DB_QUERY_ERRORS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+    return wrapper
+
+def _endpoint():
+    # Unmatched URLs share one label so random paths can't blow up the series count.
+    return request.endpoint or "none"
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+def _after_request(response):
+    REQUEST_LATENCY.labels(_endpoint(), request.method).observe(time.perf_counter() - g.metrics_start)
+    REQUEST_COUNT.labels(_endpoint(), request.method, str(response.status_code)).inc()
+    g.metrics_recorded = True
+    return response
+
+def _teardown_request(exc):
+    if "metrics_start" not in g:
+        return
+    if not g.get("metrics_recorded"):  # unhandled exception, after_request never ran
+        REQUEST_LATENCY.labels(_endpoint(), request.method).observe(time.perf_counter() - g.metrics_start)
+        REQUEST_COUNT.labels(_endpoint(), request.method, "500").inc()
+    IN_FLIGHT.dec()
+
+def metrics_response():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "FUN_metrics", metrics_response)
@@ -1,24 +1,88 @@
-import datetime
-import hashlib
-from flask_sqlalchemy import SQLAlchemy
-
-db = SQLAlchemy()
-
-class User(db.Model):
-    __tablename__ = "users"
-    id = db.Column(db.Text, primary_key=True)
-    pw = db.Column(db.Text, nullable=False)
-
-class Note(db.Model):
-    __tablename__ = "notes"
-    user      = db.Column(db.Text, db.ForeignKey("users.id"), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
-    note      = db.Column(db.Text, nullable=False)
-    note_id   = db.Column(db.Text, primary_key=True)
-
-class Image(db.Model):
-    __tablename__ = "images"
-    uid       = db.Column(db.Text, primary_key=True)
-    owner     = db.Column(db.Text, db.ForeignKey("users.id"), nullable=False)
-    name      = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+from collections import namedtuple
+
+# The tables of the app, as schema.py creates them. With SQLite every table
+# lives in its own file (database_file/<db_type>.db); PostgreSQL keeps them all
+# in one database. Columns mirror the tables as they have always been created
+# (timestamps are stored as text), so existing databases match these
+# definitions; columns added later are appended to the end of a table.
+#
+# "serial" is an auto-incrementing integer primary key on either backend.
+
+Column = namedtuple("Column", "name type constraints", defaults=("",))
+Index = namedtuple("Index", "name columns")
+Table = namedtuple("Table", "db_type name columns indexes", defaults=((),))
+
+USERS = Table("users", "users", [
+    Column("id", "text", "PRIMARY KEY"),
+    Column("pw", "text"),
+])
+
+NOTES = Table("notes", "notes", [
+    Column("user", "text"),
+    Column("timestamp", "text"),
+    Column("note", "text"),
+    Column("note_id", "text"),
+], indexes=[
+    # Keyset pagination of the private page (newest first per user); also serves
+    # lookups by user alone.
+    Index("notes_user_timestamp_idx", ["user", "timestamp", "note_id"]),
+    # match_user_id_with_note_id and delete_note_from_db
+    Index("notes_note_id_idx", ["note_id"]),
+])
+
+IMAGES = Table("images", "images", [
+    Column("uid", "text", "UNIQUE"),
+    Column("owner", "text"),
+    Column("name", "text"),
+    Column("timestamp", "text"),
+    Column("path", "text"),
+    Column("thumb_path", "text"),
+    Column("medium_path", "text"),
+], indexes=[
+    # Reference counting of content addressed blobs
+    Index("images_path_idx", ["path"]),
+    # Same as notes, for the images of a user
+    Index("images_owner_timestamp_idx", ["owner", "timestamp", "uid"]),
+])
+
+# Durable background jobs (jobs.py). Lives next to users so that a job can be
+# enqueued in the same transaction as the rows it cleans up after.
+JOBS = Table("users", "jobs", [
+    Column("id", "serial"),
+    Column("kind", "text", "NOT NULL"),
+    Column("payload", "text", "NOT NULL"),
+    Column("status", "text", "NOT NULL"),
+    Column("attempts", "integer", "NOT NULL DEFAULT 0"),
+    Column("total", "integer", "NOT NULL DEFAULT 0"),
+    Column("done", "integer", "NOT NULL DEFAULT 0"),
+    Column("last_error", "text"),
+    Column("run_after", "double precision", "NOT NULL"),
+    Column("locked_at", "double precision"),
+    Column("created", "text", "NOT NULL"),
+    Column("updated", "text", "NOT NULL"),
+], indexes=[
+    Index("jobs_status_run_after_idx", ["status", "run_after"]),
+])
+
+# Tokens for the JSON API (api.py), stored as the sha256 of the token.
+API_TOKENS = Table("users", "api_tokens", [
+    Column("token_hash", "text", "PRIMARY KEY"),
+    Column("user", "text", "NOT NULL"),
+    Column("created", "text", "NOT NULL"),
+], indexes=[
+    Index("api_tokens_user_idx", ["user"]),
+])
+
+# Server-side sessions (sessions.py), keyed by the sha256 of the session cookie.
+# Next to users so that deleting a user revokes their sessions in the same transaction.
+SESSIONS = Table("users", "sessions", [
+    Column("sid_hash", "text", "PRIMARY KEY"),
+    Column("user", "text"),
+    Column("data", "text", "NOT NULL"),
+    Column("expires", "double precision", "NOT NULL"),
+], indexes=[
+    Index("sessions_user_idx", ["user"]),
+    Index("sessions_expires_idx", ["expires"]),
+])
+
+TABLES = [USERS, NOTES, IMAGES, JOBS, API_TOKENS, SESSIONS]
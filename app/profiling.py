@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import hmac
+import json
+import random
+import pstats
+import cProfile
+import logging
+import argparse
+import threading
+import contextvars
+import functools
+from collections import Counter
+from jinja2 import Template
+
+# Opt-in request profiling (PROFILE_ENABLED). A sampled request (a share of
+# PROFILE_SAMPLE_RATE, or any request carrying "X-Profile: <PROFILE_TOKEN>") is
+# run under cProfile and records a span for every connection checkout, query,
+# template render and storage call. Its pstats dump and a JSON report go to
+# PROFILE_DIR; the response carries a Server-Timing header, and the log gets a
+# one-line summary. A query repeated PROFILE_REPEATED_QUERY_THRESHOLD times
+# within one request is logged as a likely N+1.
+#
+# Requests that aren't sampled only pay for a context variable lookup in the
+# hooks (get_connection, @traced functions), and nothing at all when disabled.
+#
+#   python profiling.py show profiles/<name>.prof --sort cumulative
+
+logger = logging.getLogger("profiling")
+
+HEADER = "HTTP_X_PROFILE"
+KINDS = ("connect", "query", "template", "file")
+
+_trace = contextvars.ContextVar("trace", default=None)
+# Python 3.12 allows a single active profiler per process (and it sees every
+# thread), so concurrent sampled requests only get their spans.
+_profiler_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = []  # (kind, detail, offset, duration), in seconds
+        self.queries = Counter()
+        self.status = None
+        self.request_id = None
+
+    def add(self, kind, detail, start, duration):
+        self.spans.append((kind, detail, start - self.start, duration))
+
+    def query(self, sql, start, duration):
+        sql = " ".join(sql.split())
+        self.queries[sql] += 1
+        self.add("query", sql, start, duration)
+
+    def totals(self):
+        totals = dict.fromkeys(KINDS, 0.0)
+        for kind, _, _, duration in self.spans:
+            totals[kind] += duration
+        return totals
+
+    def repeated(self, threshold):
+        return [(sql, n) for sql, n in self.queries.most_common() if n >= threshold]
+
+    def server_timing(self):
+        # Whatever is not database, templates or files counts as Python time.
+        elapsed = time.perf_counter() - self.start
+        totals = self.totals()
+        parts = [f"{kind};dur={totals[kind] * 1000:.1f}" for kind in KINDS]
+        return ", ".join(parts + [f"python;dur={max(0.0, elapsed - sum(totals.values())) * 1000:.1f}"])
+
+def current():
+    return _trace.get()
+
+def traced(kind):
+    # Decorator: records a span for every call made during a sampled request.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(kind, func.__name__, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class TracedCursor:
+    def __init__(self, cursor, trace):
+        self._cursor = cursor
+        self._trace = trace
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, *args)
+        finally:
+            self._trace.query(sql, start, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, *args)
+        finally:
+            self._trace.query(sql, start, time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class TracedConnection:
+    """Wraps a pooled connection so that its cursors record their queries."""
+
+    def __init__(self, conn, trace):
+        self._conn = conn
+        self._trace = trace
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._conn.cursor(*args, **kwargs), self._trace)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.close()
+        return False
+
+
+class TracedTemplate(Template):
+    def render(self, *args, **kwargs):
+        trace = _trace.get()
+        if trace is None:
+            return super().render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            trace.add("template", self.name, start, time.perf_counter() - start)
+
+
+class _ProfiledBody:
+    # The response body; the trace and the profiler stay active until the server
+    # closes it, so streamed responses are measured to their last chunk.
+    def __init__(self, app_iter, finish):
+        self._app_iter = app_iter
+        self._finish = finish
+
+    def __iter__(self):
+        return iter(self._app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, "close"):
+                self._app_iter.close()
+        finally:
+            self._finish()
+
+
+class ProfilingMiddleware:
+    def __init__(self, wsgi_app, rate=0.0, token="", directory="profiles", repeat_threshold=5):
+        self.wsgi_app = wsgi_app
+        self.rate = rate
+        self.token = token
+        self.directory = directory
+        self.repeat_threshold = repeat_threshold
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _sampled(self, environ):
+        if self.token and hmac.compare_digest(environ.get(HEADER, ""), self.token):
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def __call__(self, environ, start_response):
+        if not self._sampled(environ):
+            return self.wsgi_app(environ, start_response)
+
+        trace = Trace(environ.get("REQUEST_METHOD", ""), environ.get("PATH_INFO", ""))
+        _trace.set(trace)
+        profiler = cProfile.Profile() if _profiler_lock.acquire(blocking=False) else None
+
+        def traced_start_response(status, headers, exc_info=None):
+            trace.status = status.split(" ", 1)[0]
+            trace.request_id = next((v for k, v in headers if k.lower() == "x-request-id"), None)
+            return start_response(status, headers + [("Server-Timing", trace.server_timing())], exc_info)
+
+        def finish():
+            if profiler is not None:
+                profiler.disable()
+                _profiler_lock.release()
+            _trace.set(None)
+            self._report(trace, profiler)
+
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:  # another tool (a debugger, coverage) holds the profiler slot
+                _profiler_lock.release()
+                profiler = None
+        try:
+            app_iter = self.wsgi_app(environ, traced_start_response)
+        except BaseException:
+            finish()
+            raise
+        return _ProfiledBody(app_iter, finish)
+
+    def _report(self, trace, profiler):
+        elapsed = time.perf_counter() - trace.start
+        totals = trace.totals()
+        logger.info("Profiled %s %s (%s) in %.1f ms: %d queries %.1f ms, connect %.1f ms, templates %.1f ms, files %.1f ms",
+                    trace.method, trace.path, trace.status, elapsed * 1000, sum(trace.queries.values()),
+                    totals["query"] * 1000, totals["connect"] * 1000, totals["template"] * 1000, totals["file"] * 1000)
+        repeated = trace.repeated(self.repeat_threshold)
+        for sql, n in repeated:
+            logger.warning("Possible N+1 in %s %s: %d x %s", trace.method, trace.path, n, sql)
+        if not self.directory:
+            return
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", trace.path).strip("_") or "root"
+        name = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{trace.method}-{slug}-{trace.request_id or id(trace)}")
+        if profiler is not None:
+            profiler.dump_stats(name + ".prof")
+        with open(name + ".json", "w") as f:
+            json.dump({
+                "method": trace.method, "path": trace.path, "status": trace.status, "request_id": trace.request_id,
+                "duration_ms": round(elapsed * 1000, 3),
+                "totals_ms": {k: round(v * 1000, 3) for k, v in totals.items()},
+                "repeated_queries": [{"sql": sql, "count": n} for sql, n in repeated],
+                "spans": [{"kind": kind, "detail": detail, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                          for kind, detail, offset, duration in trace.spans],
+            }, f, indent=2)
+
+
+def init_app(app):
+    if not app.config['PROFILE_ENABLED']:
+        return
+    app.jinja_env.template_class = TracedTemplate
+    app.jinja_env.cache.clear()
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, rate=app.config['PROFILE_SAMPLE_RATE'], token=app.config['PROFILE_TOKEN'],
+                                       directory=app.config['PROFILE_DIR'], repeat_threshold=app.config['PROFILE_REPEATED_QUERY_THRESHOLD'])
+    logger.info("Profiling %.1f%% of requests%s", app.config['PROFILE_SAMPLE_RATE'] * 100,
+                " and those with X-Profile" if app.config['PROFILE_TOKEN'] else "")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Request profiles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show_parser = subparsers.add_parser("show", help="print the top functions of a .prof dump")
+    show_parser.add_argument("file")
+    show_parser.add_argument("--sort", default="cumulative", help="pstats sort key (cumulative, tottime, calls, ...)")
+    show_parser.add_argument("--limit", type=int, default=30)
+    args = parser.parse_args()
+
+    pstats.Stats(args.file).strip_dirs().sort_stats(args.sort).print_stats(args.limit)
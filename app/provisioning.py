@@ -0,0 +1,84 @@
+import io
+import sys
+import csv
+import codecs
+import argparse
+
+from database import upsert_users, iter_users
+
+# Bulk user provisioning from CSV ("id,password" rows, an optional header line).
+# Rows are read one at a time and written in batches, each batch in its own
+# transaction, so neither the file nor the user table is ever held in memory.
+# Used by the admin page (/admin/import_users, /admin/export_users) and from
+# the command line:
+#
+#   python provisioning.py import users.csv
+#   python provisioning.py export > users.csv
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+
+def invalid_user_id(id):
+    # Same rules as the admin form. Returns why an id is rejected, or None.
+    if not id:
+        return "empty id"
+    if " " in id or "'" in id:
+        return "id contains a space or a quote"
+    if id.upper() == "ADMIN":
+        return "the ADMIN account can't be changed by an import"
+    return None
+
+def import_users(lines, batch_size=BATCH_SIZE):
+    # `lines` is any iterable of text lines, e.g. an open file. Existing users get
+    # the new password. Returns (imported, rejected, errors), where errors lists
+    # the first MAX_REPORTED_ERRORS problems as (line number, reason).
+    imported, rejected, errors, batch = 0, 0, [], []
+    for line_number, row in enumerate(csv.reader(lines), start=1):
+        if line_number == 1 and [x.strip().lower() for x in row] == ["id", "password"]:
+            continue
+        if not row:
+            continue
+        reason = "expected id,password" if len(row) != 2 or not row[1] else invalid_user_id(row[0].strip())
+        if reason:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((line_number, reason))
+            continue
+        batch.append((row[0].strip(), row[1]))
+        if len(batch) >= batch_size:
+            upsert_users(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        upsert_users(batch)
+        imported += len(batch)
+    return imported, rejected, errors
+
+def decode_lines(stream):
+    # Binary stream (e.g. an upload) -> text lines, read lazily.
+    return codecs.iterdecode(stream, "utf-8-sig")
+
+def export_users():
+    # CSV text, a line at a time.
+    yield "id\r\n"
+    for id in iter_users():
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([id])
+        yield buffer.getvalue()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk user import and export (CSV)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="create or update users from id,password rows")
+    import_parser.add_argument("file", help='CSV file, or "-" for stdin')
+    subparsers.add_parser("export", help="write all user ids to stdout")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        sys.stdout.writelines(export_users())
+    else:
+        with (open(args.file, newline="", encoding="utf-8-sig") if args.file != "-" else sys.stdin) as f:
+            imported, rejected, errors = import_users(f)
+        print(f"Imported {imported} users, rejected {rejected}")
+        for line_number, reason in errors:
+            print(f"  line {line_number}: {reason}")
@@ -0,0 +1,146 @@
+import logging
+from database import get_connection, USE_POSTGRES
+from models import TABLES
+
+if not USE_POSTGRES:
+    import sqlite3
+
+logger = logging.getLogger("schema")
+
+# Creates the tables, columns and indexes declared in models.py that are
+# missing. Every step is idempotent, so upgrade() is safe to run on every start.
+
+# Full-text search over notes (search_notes in database.py). On SQLite an FTS5 table
+# indexes notes.note by rowid and triggers keep it current; on PostgreSQL a generated
+# tsvector column does, with a GIN index. Either way every write to notes (including
+# the deletions of delete_user_from_db) updates the index in the same transaction.
+# SQLite may renumber the rowids of notes on VACUUM; run python schema.py --rebuild-search after one.
+SQLITE_SEARCH = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(note, content='notes', content_rowid='rowid');",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN "
+    "INSERT INTO notes_fts(rowid, note) VALUES (new.rowid, new.note); END;",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN "
+    "INSERT INTO notes_fts(notes_fts, rowid, note) VALUES ('delete', old.rowid, old.note); END;",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE ON notes BEGIN "
+    "INSERT INTO notes_fts(notes_fts, rowid, note) VALUES ('delete', old.rowid, old.note); "
+    "INSERT INTO notes_fts(rowid, note) VALUES (new.rowid, new.note); END;",
+]
+POSTGRES_SEARCH = [
+    "ALTER TABLE notes ADD COLUMN IF NOT EXISTS note_tsv tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(note, ''))) STORED;",
+    "CREATE INDEX IF NOT EXISTS notes_tsv_idx ON notes USING GIN (note_tsv);",
+]
+
+def _quote(name):
+    # Some column names ("user") are reserved words in PostgreSQL.
+    return f'"{name}"'
+
+def _column_sql(column):
+    if column.type == "serial":
+        return f"{_quote(column.name)} " + ("SERIAL PRIMARY KEY" if USE_POSTGRES else "INTEGER PRIMARY KEY AUTOINCREMENT")
+    return f"{_quote(column.name)} {column.type} {column.constraints}".rstrip()
+
+def _columns(_c, table):
+    if USE_POSTGRES:
+        _c.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s;", (table,))
+        return {x[0] for x in _c.fetchall()}
+    _c.execute(f"PRAGMA table_info({table});")
+    return {x[1] for x in _c.fetchall()}
+
+def _indexes(_c, table):
+    if USE_POSTGRES:
+        _c.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s;", (table,))
+        return {x[0] for x in _c.fetchall()}
+    _c.execute(f"PRAGMA index_list({table});")
+    return {x[1] for x in _c.fetchall()}
+
+def _create_table(table):
+    with get_connection(table.db_type) as _conn:
+        _c = _conn.cursor()
+        columns = ", ".join(_column_sql(x) for x in table.columns)
+        _c.execute(f"CREATE TABLE IF NOT EXISTS {table.name} ({columns});")
+        _conn.commit()
+
+def _add_column(table, column):
+    # Only plain columns can be added to an existing table; constraints are
+    # for the columns a table is created with.
+    with get_connection(table.db_type) as _conn:
+        _c = _conn.cursor()
+        if column.name in _columns(_c, table.name):
+            return False
+        logger.info("Adding column %s.%s", table.name, column.name)
+        if USE_POSTGRES:
+            _c.execute(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {_quote(column.name)} {column.type};")
+        else:
+            try:
+                _c.execute(f"ALTER TABLE {table.name} ADD COLUMN {_quote(column.name)} {column.type};")
+            except sqlite3.OperationalError as e:
+                # Another worker got there first.
+                if "duplicate column" not in str(e):
+                    raise
+        _conn.commit()
+        return True
+
+def _add_index(table, index):
+    with get_connection(table.db_type) as _conn:
+        _c = _conn.cursor()
+        columns = ", ".join(_quote(x) for x in index.columns)
+        _c.execute(f"CREATE INDEX IF NOT EXISTS {index.name} ON {table.name} ({columns});")
+        _conn.commit()
+
+def _search_index_exists(_c):
+    if USE_POSTGRES:
+        return "notes_tsv_idx" in _indexes(_c, "notes")
+    _c.execute("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts';")
+    return _c.fetchone() is not None
+
+def _add_search_index(rebuild=False):
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        created = not _search_index_exists(_c)
+        for statement in (POSTGRES_SEARCH if USE_POSTGRES else SQLITE_SEARCH):
+            _c.execute(statement)
+        if not USE_POSTGRES and (created or rebuild):
+            # Index the notes that existed before the FTS table.
+            _c.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild');")
+        _conn.commit()
+
+def upgrade():
+    changed = []
+    for table in TABLES:
+        _create_table(table)
+        for column in table.columns:
+            if _add_column(table, column):
+                changed.append(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            _add_index(table, index)
+    _add_search_index()
+    return changed
+
+def missing_indexes():
+    missing = []
+    for table in TABLES:
+        with get_connection(table.db_type) as _conn:
+            existing = _indexes(_conn.cursor(), table.name)
+        missing.extend(f"{table.name}.{x.name}" for x in table.indexes if x.name not in existing)
+    with get_connection("notes") as _conn:
+        if not _search_index_exists(_conn.cursor()):
+            missing.append("notes.notes_tsv_idx" if USE_POSTGRES else "notes.notes_fts")
+    return missing
+
+def check_indexes():
+    # Without these indexes, lookups such as match_user_id_with_note_id scan the whole table.
+    missing = missing_indexes()
+    for name in missing:
+        logger.warning("Index %s is missing, run python schema.py to create it", name)
+    return missing
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create missing tables, columns and indexes")
+    parser.add_argument("--rebuild-search", action="store_true", help="re-index all notes for search (SQLite)")
+    args = parser.parse_args()
+
+    print(upgrade() or "Schema is up to date")
+    if args.rebuild_search:
+        _add_search_index(rebuild=True)
@@ -0,0 +1,210 @@
+import json
+import time
+import hashlib
+import logging
+import secrets
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from config import get_config
+from cache import TTLCache, MemoryBackend, RedisBackend
+from database import load_session, save_session, delete_session, delete_user_sessions, delete_expired_sessions
+
+# Server-side sessions. The cookie only holds a random session id; the data lives
+# in a store (SESSION_STORE):
+#
+#   database  the sessions table, next to users (the default)
+#   kv        Redis at CACHE_REDIS_URL, or an in-process stand-in without it
+#             (which only works with a single worker)
+#
+# Either way, deleting a user revokes all their sessions. Sessions that were read
+# recently can be kept in memory for SESSION_CACHE_TTL seconds, so most requests
+# make no round trip for them. That copy is per worker and nothing tells the others
+# when a session changes (a logout, a flash shown, a revocation), so it is off
+# unless SESSION_CACHE_TTL is set, e.g. with a single worker.
+#
+# Notes and images never change owner, so ownership checks (owns()) remember the
+# ids a user was found to own and answer from memory after the first lookup.
+
+logger = logging.getLogger("sessions")
+
+_config = get_config()
+PURGE_INTERVAL = 3600
+
+# sha256 of a session id -> (user, data)
+_cache = TTLCache(maxsize=_config.SESSION_CACHE_SIZE, ttl=_config.SESSION_CACHE_TTL)
+# (user, kind) -> set of ids the user owns
+_owned = TTLCache(maxsize=_config.SESSION_CACHE_SIZE, ttl=_config.OWNERSHIP_CACHE_TTL)
+MAX_OWNED_PER_USER = 10000
+_MISSING = object()
+
+
+class DatabaseStore:
+    def __init__(self):
+        self._next_purge = 0
+
+    def load(self, sid_hash):
+        return load_session(sid_hash)
+
+    def save(self, sid_hash, user, data, ttl):
+        save_session(sid_hash, user, data, time.time() + ttl)
+        if time.monotonic() > self._next_purge:
+            self._next_purge = time.monotonic() + PURGE_INTERVAL
+            logger.info("Purged %d expired sessions", delete_expired_sessions())
+
+    def delete(self, sid_hash):
+        delete_session(sid_hash)
+
+    def revoke_user(self, user):
+        # delete_user_from_db also deletes them, in the transaction that deletes the user.
+        delete_user_sessions(user)
+
+
+class KeyValueStore:
+    """Sessions in a cache backend; revoking bumps a per-user generation."""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def load(self, sid_hash):
+        value = self._backend.get(f"session:{sid_hash}")
+        if value is None:
+            return None
+        user, generation, data = json.loads(value)
+        if user is not None and generation != self._generation(user):
+            return None
+        return user, data
+
+    def save(self, sid_hash, user, data, ttl):
+        generation = self._generation(user) if user is not None else None
+        self._backend.set(f"session:{sid_hash}", json.dumps([user, generation, data]), ttl=ttl)
+
+    def delete(self, sid_hash):
+        self._backend.delete(f"session:{sid_hash}")
+
+    def revoke_user(self, user):
+        self._backend.incr(f"session-generation:{user}")
+
+    def _generation(self, user):
+        return self._backend.get(f"session-generation:{user}") or "0"
+
+
+def make_store(name):
+    if name == "database":
+        return DatabaseStore()
+    if name == "kv":
+        # Unlike the page cache, sessions can't quietly fall back to memory: with
+        # several workers a login would only be known to one of them.
+        return KeyValueStore(RedisBackend(_config.CACHE_REDIS_URL) if _config.CACHE_REDIS_URL else MemoryBackend())
+    raise ValueError(f"Unknown SESSION_STORE {name!r}, expected 'database' or 'kv'")
+
+
+def _sid_hash(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.stale_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        # New id for the same data, e.g. at login, so an id known before can't be reused.
+        if self.sid is not None:
+            self.stale_sid, self.sid = self.sid, None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _load(self, sid):
+        sid_hash = _sid_hash(sid)
+        entry = _cache.get(sid_hash, _MISSING)
+        if entry is _MISSING:
+            entry = self.store.load(sid_hash)
+            _cache.set(sid_hash, entry)
+        return None if entry is None else self.serializer.loads(entry[1])
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        data = self._load(sid) if sid else None
+        return ServerSession() if data is None else ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.stale_sid is not None:
+            self._delete(session.stale_sid)
+        if not session:
+            if session.modified and session.sid is not None:
+                self._delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        sid_hash, user, data = _sid_hash(session.sid), session.get("current_user"), self.serializer.dumps(dict(session))
+        self.store.save(sid_hash, user, data, app.permanent_session_lifetime.total_seconds())
+        _cache.set(sid_hash, (user, data))
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def _delete(self, sid):
+        sid_hash = _sid_hash(sid)
+        self.store.delete(sid_hash)
+        _cache.delete(sid_hash)
+
+
+def revoke_user(app, user):
+    # Logs the user out everywhere. With SESSION_CACHE_TTL set, other workers may
+    # still have a session cached until it expires; this one forgets all of them,
+    # as the cache can't be searched by user.
+    user = user.upper()
+    app.session_interface.store.revoke_user(user)
+    _cache.clear()
+    for kind in ("note", "image"):
+        _owned.delete((user, kind))
+
+
+def owns(user, kind, object_id, lookup):
+    # Whether `user` owns the note or image `object_id`; lookup(object_id) returns
+    # the owner from the database. Only positive answers are remembered: an id
+    # always keeps its owner, while one that doesn't exist yet may be created later.
+    if user is None:
+        return False
+    owned = _owned.get((user, kind))
+    if owned is not None and object_id in owned:
+        return True
+    if lookup(object_id) != user:
+        return False
+    remember(user, kind, object_id)
+    return True
+
+def remember(user, kind, object_id):
+    # Also called for new notes and images, so deleting them needs no lookup.
+    owned = _owned.get((user, kind))
+    if owned is None:
+        owned = set()
+        _owned.set((user, kind), owned)
+    if len(owned) < MAX_OWNED_PER_USER:
+        owned.add(object_id)
+
+def forget(user, kind, object_id):
+    owned = _owned.get((user, kind))
+    if owned is not None:
+        owned.discard(object_id)
+
+
+def init_app(app):
+    app.session_interface = ServerSessionInterface(make_store(app.config['SESSION_STORE']))
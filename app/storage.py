@@ -0,0 +1,215 @@
+import os
+import re
+import fcntl
+import hashlib
+import argparse
+import logging
+import tempfile
+import contextlib
+
+from profiling import traced
+
+# The image pool is content addressed: every file is stored once, under the
+# SHA-256 of its bytes, in a two level hash-sharded tree (e.g. "3a/fa/3afa...")
+# so that no directory grows past a few thousand entries. images.path records
+# the blob of each upload; several rows may share one blob, and the blob is
+# only removed when the last row referencing it is gone. Adding and removing a
+# blob happen under its lock (see blob_lock), so an upload of the same content
+# can't slip in between a delete counting the references and unlinking the file.
+
+CHUNK_SIZE = 64 * 1024
+TMP_DIR = ".tmp"
+LOCK_DIR = ".locks"
+LEGACY_NAME = re.compile(r"^([0-9a-f]{40})-(.+)$")
+
+logger = logging.getLogger("storage")
+
+def shard_path(key, filename=None):
+    name = key if filename is None else f"{key}-{filename}"
+    return os.path.join(key[0:2], key[2:4], name)
+
+def legacy_path(image_uid, filename):
+    # Where uploads lived before the sharded layout (flat "<uid>-<name>").
+    return f"{image_uid}-{filename}"
+
+def absolute_path(root, path):
+    return os.path.join(root, path)
+
+def blob_key(image_uid, path):
+    # Content hash for content addressed blobs, the uid for legacy flat files.
+    return os.path.basename(path) if path else image_uid
+
+def variant_path(key, variant, extension):
+    # Resized variants ("thumb", "medium") live next to their original blob.
+    return os.path.join(key[0:2], key[2:4], f"{key}.{variant}.{extension}")
+
+@traced("file")
+def remove_variants(root, key):
+    # Shard directories only hold a handful of entries, so scanning one is cheap.
+    shard_dir = absolute_path(root, os.path.join(key[0:2], key[2:4]))
+    try:
+        with os.scandir(shard_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(key + "."):
+                    os.remove(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+class HashingTempFile:
+    """Temporary file inside the pool that hashes everything written to it.
+
+    Used as the upload stream, so the content hash is known as soon as the
+    request body has been received and the file only has to be renamed.
+    """
+
+    def __init__(self, root):
+        tmp_dir = os.path.join(root, TMP_DIR)
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=tmp_dir)
+        self._file = os.fdopen(fd, "w+b")
+        self._digest = hashlib.sha256()
+        self._committed = False
+        self.size = 0
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def close(self):
+        self._file.close()
+        if not self._committed:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
+
+
+@traced("file")
+def stage(stream, root):
+    # Uploads parsed by UploadRequest are already hashed; anything else is copied in chunks.
+    if isinstance(stream, HashingTempFile):
+        return stream
+    staged = HashingTempFile(root)
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        staged.write(chunk)
+    return staged
+
+def blob_path(staged):
+    return shard_path(staged.hexdigest())
+
+@contextlib.contextmanager
+def blob_lock(root, path):
+    # An exclusive flock, held across threads and worker processes. Blobs share
+    # 256 lock files (by their first two hex digits) rather than one file each.
+    lock_dir = os.path.join(root, LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, os.path.basename(path)[0:2]), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@traced("file")
+def commit(root, staged, path):
+    # Record the row before calling this: a delete that takes the lock after us
+    # sees the new reference and keeps the blob, and one that took it before us
+    # has already unlinked it, so we move ours in.
+    full_path = absolute_path(root, path)
+    with blob_lock(root, path):
+        if os.path.exists(full_path):
+            return False  # duplicate content, the temp file is dropped on close()
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        staged.flush()
+        os.chmod(staged.name, 0o644)
+        os.replace(staged.name, full_path)
+        staged._committed = True
+        return True
+
+@traced("file")
+def remove(root, path):
+    try:
+        os.remove(absolute_path(root, path))
+        return True
+    except FileNotFoundError:
+        logger.warning("Image file already gone: %s", path)
+        return False
+
+def remove_unreferenced(root, path, unreferenced_paths):
+    # Removes a blob and its variants unless a row points to it again, re-checked
+    # (unreferenced_paths, from database) under the blob's lock.
+    with blob_lock(root, path):
+        if not unreferenced_paths([path]):
+            return False
+        remove(root, path)
+        remove_variants(root, blob_key(None, path))
+        return True
+
+@traced("file")
+def file_digest(full_path):
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def migrate_flat_pool(root, dry_run=False, batch_size=500):
+    # Moves "<uid>-<name>" files from the top level of the pool into the content
+    # addressed layout, dropping duplicates, and records the blob of every row.
+    # Only top-level files are touched, so an interrupted run can be re-run.
+    from schema import upgrade
+    from database import set_image_paths
+
+    if not dry_run:
+        upgrade()
+    moved, deduplicated, skipped, pending = 0, 0, 0, []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            match = LEGACY_NAME.match(entry.name)
+            if not entry.is_file() or match is None:
+                skipped += 1
+                continue
+            path = shard_path(file_digest(entry.path))
+            full_path = absolute_path(root, path)
+            if os.path.exists(full_path):
+                deduplicated += 1
+                if not dry_run:
+                    os.remove(entry.path)
+            else:
+                moved += 1
+                if not dry_run:
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    os.replace(entry.path, full_path)
+            if not dry_run:
+                pending.append((match.group(1), path))
+                if len(pending) >= batch_size:
+                    set_image_paths(pending)
+                    pending = []
+    if pending:
+        set_image_paths(pending)
+    return moved, deduplicated, skipped
+
+if __name__ == "__main__":
+    from config import get_config
+
+    parser = argparse.ArgumentParser(description="Image pool storage tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="move a flat image pool into the content addressed layout")
+    migrate.add_argument("--root", default=get_config().UPLOAD_FOLDER)
+    migrate.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    moved, deduplicated, skipped = migrate_flat_pool(args.root, dry_run=args.dry_run)
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} files, "
+          f"{deduplicated} duplicates, skipped {skipped} entries")
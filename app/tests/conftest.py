@@ -5,6 +5,9 @@ import os
 # Add current directory to the import path so Python can find app.py
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + "/.."))
 
+# Tests run the job queue explicitly with jobs.run_pending().
+os.environ.setdefault("JOB_WORKER_ENABLED", "false")
+
 from app import app as flask_app
 from database import add_user, delete_user_from_db
 
@@ -1,5 +1,8 @@
 
+import pytest
 import io
+import os
+from app import app as flask_app
 
 def test_index(client):
     response = client.get("/")
@@ -85,6 +88,41 @@ def test_delete_image(client, test_user):
     response = client.get(f"/delete_image/{uid}", follow_redirects=True)
     assert response.status_code == 200
 
+def test_delete_image_keeps_blob_uploaded_again_meanwhile(client, test_user, monkeypatch):
+    import app as app_module
+    import hashlib
+    import storage
+    from database import list_images_for_user, image_upload_record, delete_image_from_db
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    content = b"fake-image-data-raced"
+    client.post("/upload_image", data={"file": (io.BytesIO(content), "raced.jpg")}, content_type='multipart/form-data')
+    uid = list_images_for_user(test_user[0])[-1][0]
+    path = storage.shard_path(hashlib.sha256(content).hexdigest())
+
+    def delete_then_duplicate_upload(image_uid):
+        # A duplicate upload records its row right after the delete counted no references left.
+        deleted = delete_image_from_db(image_uid)
+        assert deleted[2] == 0
+        image_upload_record("raced" + image_uid[5:], test_user[0], "again.jpg", "now", path)
+        return deleted
+    monkeypatch.setattr(app_module, "delete_image_from_db", delete_then_duplicate_upload)
+
+    client.get(f"/delete_image/{uid}")
+    assert os.path.exists(storage.absolute_path(flask_app.config['UPLOAD_FOLDER'], path))
+
+def test_delete_twice_redirects(client, test_user):
+    from database import list_images_for_user, read_note_from_db
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.post("/upload_image", data={"file": (io.BytesIO(b"fake-image-data-twice"), "twice.jpg")}, content_type='multipart/form-data')
+    client.post("/write_note", data={"text_note_to_take": "Deleted Twice"})
+    uid = list_images_for_user(test_user[0])[-1][0]
+    note_id = read_note_from_db(test_user[0])[-1][0]
+    for _ in range(2):
+        assert client.get(f"/delete_image/{uid}").status_code == 302
+        assert client.get(f"/delete_note/{note_id}").status_code == 302
+    client.get("/logout/")
+    assert client.get(f"/delete_image/{uid}").status_code == 401
+
 def test_delete_user_as_admin(client, admin_user):
     from database import add_user
     add_user("DELETEUSER", "pass")
@@ -100,3 +138,647 @@ def test_delete_user_unauthorized(client, test_user):
     client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
     response = client.get("/delete_user/SHOULDNOTDELETE/", follow_redirects=True)
     assert response.status_code in [401, 403]
+
+def test_db_pool_stats_as_admin(client, admin_user):
+    client.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+    response = client.get("/admin/db_pool")
+    assert response.status_code == 200
+    assert "in_use" in response.get_json()
+
+def test_db_pool_stats_unauthorized(client):
+    response = client.get("/admin/db_pool")
+    assert response.status_code == 401
+
+def test_sqlite_connection_is_reused():
+    from database import get_connection
+    with get_connection("users") as first:
+        raw = first._conn
+    with get_connection("users") as second:
+        assert second._conn is raw
+
+def test_connection_pool_is_bounded():
+    import sqlite3
+    from db_pool import ConnectionPool, PoolTimeout
+    pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False), size=1, timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    conn.close()
+    again = pool.acquire()
+    assert pool.stats()["opened"] == 1 and pool.stats()["timeouts"] == 1
+    again.close()
+    assert pool.stats()["idle"] == 1
+
+def test_connection_pool_recycles_old_connections():
+    import sqlite3
+    from db_pool import ConnectionPool
+    pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False), size=1, max_lifetime=0.01)
+    first = pool.acquire()
+    raw = first._conn
+    first.close()
+    import time
+    time.sleep(0.02)
+    with pool.acquire() as second:
+        assert second._conn is not raw
+    assert pool.stats()["recycled"] == 1
+
+def test_verify_unknown_user():
+    from database import verify, user_exists
+    assert not user_exists("NOSUCHUSER")
+    assert not verify("NOSUCHUSER", "whatever")
+
+def test_user_cache_invalidated_on_delete(test_user, monkeypatch):
+    import database
+    from cache import UserDataCache
+    from database import user_exists, verify, delete_user_from_db, add_user
+    monkeypatch.setattr(database, "_user_cache", UserDataCache("users", ttl=30))
+    assert user_exists(test_user[0])
+    delete_user_from_db(test_user[0])
+    assert not user_exists(test_user[0])
+    add_user(test_user[0], "changed")
+    assert verify(test_user[0], "changed")
+    assert not verify(test_user[0], test_user[1])
+
+def test_password_change_reaches_another_worker(test_user):
+    # A forked worker resets the password; this one must stop accepting the old one.
+    import database
+    from database import verify, add_user
+    assert not database._user_cache.enabled  # no shared backend configured
+    assert verify(test_user[0], test_user[1])
+    pid = os.fork()
+    if pid == 0:
+        try:
+            add_user(test_user[0], "changed")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert not verify(test_user[0], test_user[1])
+
+def test_ttl_cache_evicts_least_recently_used():
+    from cache import TTLCache
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+def test_upload_image_is_content_addressed(client, test_user):
+    import hashlib
+    from database import list_images_for_user, get_image_file
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    for name in ["first.png", "second.png"]:
+        client.post("/upload_image", data={"file": (io.BytesIO(b"same-image-data"), name)}, content_type='multipart/form-data')
+
+    uids = [x[0] for x in list_images_for_user(test_user[0]) if x[2] in ("first.png", "second.png")]
+    digest = hashlib.sha256(b"same-image-data").hexdigest()
+    assert [get_image_file(uid)[2] for uid in uids] == [os.path.join(digest[0:2], digest[2:4], digest)] * 2
+    full_path = os.path.join(flask_app.config['UPLOAD_FOLDER'], digest[0:2], digest[2:4], digest)
+    assert open(full_path, "rb").read() == b"same-image-data"
+    assert os.listdir(os.path.join(flask_app.config['UPLOAD_FOLDER'], ".tmp")) == []
+
+    # The blob stays until its last reference is deleted.
+    client.get(f"/delete_image/{uids[0]}")
+    assert os.path.isfile(full_path)
+    client.get(f"/delete_image/{uids[1]}")
+    assert not os.path.exists(full_path)
+
+def test_migrate_flat_pool(tmp_path):
+    import hashlib
+    import storage
+    (tmp_path / f"{'ab' * 20}-flat.png").write_bytes(b"flat")
+    (tmp_path / f"{'cd' * 20}-copy.png").write_bytes(b"flat")
+    (tmp_path / "not-an-upload.txt").write_bytes(b"other")
+
+    assert storage.migrate_flat_pool(str(tmp_path)) == (1, 1, 1)
+    digest = hashlib.sha256(b"flat").hexdigest()
+    assert (tmp_path / digest[0:2] / digest[2:4] / digest).read_bytes() == b"flat"
+    assert storage.migrate_flat_pool(str(tmp_path)) == (0, 0, 2)
+
+def test_image_endpoint_caching_and_ranges(client, test_user):
+    from database import list_images_for_user
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.post("/upload_image", data={"file": (io.BytesIO(b"0123456789"), "served.png")}, content_type='multipart/form-data')
+    uid = [x[0] for x in list_images_for_user(test_user[0]) if x[2] == "served.png"][-1]
+
+    response = client.get(f"/image/{uid}")
+    assert response.status_code == 200
+    assert response.data == b"0123456789"
+    assert response.mimetype == "image/png"
+    assert "immutable" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    response = client.get(f"/image/{uid}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+    response = client.get(f"/image/{uid}", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.data == b"2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+
+    client.get("/logout/")
+    assert client.get(f"/image/{uid}").status_code == 401
+    assert client.get("/image/doesnotexist").status_code == 404
+
+def test_upload_generates_variants(client, test_user, monkeypatch):
+    import thumbnails
+    from PIL import Image
+    from database import list_images_for_user, get_image_file
+    monkeypatch.setattr(thumbnails._config, "THUMBNAIL_WORKERS", 0)  # generate inline
+
+    png = io.BytesIO()
+    Image.new("RGB", (1000, 500), "red").save(png, "PNG")
+    png.seek(0)
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.post("/upload_image", data={"file": (png, "big.png")}, content_type='multipart/form-data')
+    uid = [x[0] for x in list_images_for_user(test_user[0]) if x[2] == "big.png"][-1]
+
+    owner, name, path, thumb_path, medium_path = get_image_file(uid)
+    assert thumb_path.startswith(os.path.dirname(path)) and thumb_path.endswith(".thumb.webp")
+    response = client.get(f"/image/{uid}?variant=thumb")
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert Image.open(io.BytesIO(response.data)).size == (200, 100)
+    assert client.get(f"/image/{uid}?variant=huge").status_code == 404
+
+    # Running it again is a no-op that reports the same files
+    assert thumbnails.generate_variants(flask_app.config['UPLOAD_FOLDER'], uid, name, path)["medium"] == medium_path
+
+    client.get(f"/delete_image/{uid}")
+    assert not os.path.exists(os.path.join(flask_app.config['UPLOAD_FOLDER'], thumb_path))
+
+def test_private_page_keyset_pagination(client, test_user):
+    import re
+    import html
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    for i in range(5):
+        client.post("/write_note", data={"text_note_to_take": f"paged note {i}"})
+
+    seen = []
+    url = "/private/?per_page=2"
+    while url:
+        page = client.get(url).data.decode()
+        assert "Your Notes (5)" in page
+        seen += re.findall(r"paged note (\d)", page)
+        match = re.search(r'<li class="next"><a href="([^"]+)">Older notes', page)
+        url = html.unescape(match.group(1)) if match else None  # the link keeps per_page
+    assert seen == ["4", "3", "2", "1", "0"]
+
+def test_read_notes_page_uses_cursor(test_user):
+    from database import write_note_into_db, read_notes_page, count_notes
+    for i in range(3):
+        write_note_into_db(test_user[0], f"note {i}")
+    first = read_notes_page(test_user[0], limit=2)
+    rest = read_notes_page(test_user[0], before=(first[-1][1], first[-1][0]), limit=2)
+    assert [x[2] for x in first + rest] == ["note 2", "note 1", "note 0"]
+    assert count_notes(test_user[0]) == 3
+
+def test_admin_user_list_pagination(client, admin_user):
+    from database import list_users_page, count_users
+    client.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+    response = client.get("/admin/?per_page=1")
+    assert response.status_code == 200
+    assert b"Next page" in response.data and b"per_page=1" in response.data
+    first, second = list_users_page(limit=1), list_users_page(after_id=list_users_page(limit=1)[0], limit=1)
+    assert first[0] < second[0]
+    assert count_users() >= 2
+
+def test_metrics_endpoint(client, test_user):
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.get("/private/")
+    client.post("/upload_image", data={"file": (io.BytesIO(b"12345"), "m.png")}, content_type='multipart/form-data')
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.data.decode()
+    assert 'flask_request_duration_seconds_count{endpoint="FUN_private",method="GET"}' in body
+    assert 'flask_requests_total{endpoint="FUN_login",method="POST",status="302"}' in body
+    assert 'db_query_duration_seconds_count{function="read_notes_page"}' in body
+    assert "flask_upload_bytes_total" in body
+
+def test_request_id_is_echoed(client):
+    response = client.get("/", headers={"X-Request-ID": "abc123"})
+    assert response.headers["X-Request-ID"] == "abc123"
+    assert len(client.get("/").headers["X-Request-ID"]) == 32
+
+def test_json_log_records_carry_request_id():
+    import json
+    import logging
+    from logs import JsonFormatter, RequestIdFilter, request_id_var
+    record = logging.LogRecord("database", logging.INFO, __file__, 1, "Deleting user %s", ("BOB",), None)
+    token = request_id_var.set("req-1")
+    RequestIdFilter().filter(record)
+    request_id_var.reset(token)
+    line = json.loads(JsonFormatter().format(record))
+    assert line["msg"] == "Deleting user BOB"
+    assert line["request_id"] == "req-1" and line["level"] == "INFO" and line["logger"] == "database"
+
+def test_json_log_keeps_exception_through_the_queue():
+    import sys
+    import json
+    import queue
+    import logging
+    from logs import JsonFormatter, DroppingQueueHandler
+    handler = DroppingQueueHandler(queue.Queue())
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        handler.handle(logging.LogRecord("thumbnails", logging.WARNING, __file__, 1, "Could not resize %s", ("x.png",), sys.exc_info()))
+    line = json.loads(JsonFormatter().format(handler.queue.get_nowait()))
+    assert line["msg"] == "Could not resize x.png"
+    assert "ZeroDivisionError" in line["exc"]
+
+def test_debug_sampling_only_drops_debug():
+    import logging
+    from logs import SamplingFilter, parse_sampling
+    sampler = SamplingFilter(parse_sampling("database=0"))
+    debug = logging.LogRecord("database.pool", logging.DEBUG, __file__, 1, "x", None, None)
+    info = logging.LogRecord("database", logging.INFO, __file__, 1, "x", None, None)
+    other = logging.LogRecord("storage", logging.DEBUG, __file__, 1, "x", None, None)
+    assert not sampler.filter(debug)
+    assert sampler.filter(info) and sampler.filter(other)
+
+def test_delete_user_queues_file_cleanup(client, admin_user):
+    import jobs
+    from database import add_user, user_exists, list_images_for_user, get_image_file, list_recent_jobs
+    add_user("JOBUSER", "pass")
+    client.post("/login", data={"id": "JOBUSER", "pw": "pass"})
+    client.post("/upload_image", data={"file": (io.BytesIO(b"job-user-image"), "mine.png")}, content_type='multipart/form-data')
+    path = get_image_file(list_images_for_user("JOBUSER")[-1][0])[2]
+    full_path = os.path.join(flask_app.config['UPLOAD_FOLDER'], path)
+    assert os.path.isfile(full_path)
+
+    client.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+    client.get("/delete_user/JOBUSER/")
+    # The rows are gone at once, the file only once the job has run.
+    assert not user_exists("JOBUSER") and list_images_for_user("JOBUSER") == []
+    assert os.path.isfile(full_path)
+    assert jobs.run_pending() >= 1
+    assert not os.path.exists(full_path)
+    job_id, kind, status, done, total = list_recent_jobs(1)[0][:5]
+    assert (kind, status, done, total) == ("delete_files", "done", 1, 1)
+
+def test_user_data_cache_shares_invalidations():
+    from cache import UserDataCache, MemoryBackend
+    backend = MemoryBackend()
+    first, second = UserDataCache("t", backend=backend), UserDataCache("t", backend=backend)
+    rows = [("n1", "2024-01-01", "hello")]
+    assert first.get_or_load("BOB", "notes", lambda: rows) == rows
+    assert first.get_or_load("BOB", "notes", lambda: None) == rows
+    # The other process finds the entry in the backend, as JSON.
+    assert second.get_or_load("BOB", "notes", lambda: None) == [["n1", "2024-01-01", "hello"]]
+    assert (first.stats, second.stats["shared_hit"]) == ({"local_hit": 1, "shared_hit": 0, "miss": 1}, 1)
+
+    second.invalidate("BOB")
+    assert first.get_or_load("BOB", "notes", lambda: []) == []
+
+def test_private_page_cache_is_invalidated_by_writes(client, test_user, monkeypatch):
+    import database
+    from cache import UserDataCache
+    monkeypatch.setattr(database, "_private_cache", UserDataCache("private", ttl=10))
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.get("/private/")
+    misses = database._private_cache.stats["miss"]
+    client.get("/private/")
+    assert database._private_cache.stats["miss"] == misses
+
+    client.post("/write_note", data={"text_note_to_take": "cached-note"})
+    assert b"cached-note" in client.get("/private/").data
+
+def test_private_page_shows_writes_from_another_worker(client, test_user):
+    # Two gunicorn workers: this process serves the page, a forked one takes the write.
+    import database
+    assert not database._private_cache.enabled  # no shared backend configured
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    assert b"other-worker-note" not in client.get("/private/").data
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with flask_app.test_client() as other:
+                other.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+                other.post("/write_note", data={"text_note_to_take": "other-worker-note"})
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert b"other-worker-note" in client.get("/private/").data
+
+def test_logout_reaches_another_worker(client, test_user):
+    # The cookie from before the logout must not keep working on the worker that didn't serve it.
+    import sessions
+    assert not sessions._cache.enabled  # no cross-worker invalidation
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    assert client.get("/private/").status_code == 200
+    cookie = next(x.value for x in client.cookie_jar if x.name == flask_app.session_cookie_name)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with flask_app.test_client() as other:
+                other.set_cookie("localhost", flask_app.session_cookie_name, cookie)
+                other.get("/logout/")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert client.get("/private/").status_code == 401
+
+def test_schema_creates_model_indexes():
+    from schema import upgrade, check_indexes
+    from database import get_connection
+    upgrade()
+    assert check_indexes() == []
+    with get_connection("notes") as _conn:
+        _c = _conn.cursor()
+        _c.execute("EXPLAIN QUERY PLAN SELECT \"user\" FROM notes WHERE note_id = ?;", ("x",))
+        assert "notes_note_id_idx" in " ".join(str(x) for x in _c.fetchall())
+        assert _c.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+def test_prepared_statement_placeholders():
+    from database import _numbered
+    assert _numbered('SELECT 1 FROM notes WHERE "user" = %s LIMIT %s') == 'SELECT 1 FROM notes WHERE "user" = $1 LIMIT $2'
+
+def test_search_notes(client, test_user):
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    for note in ["buy oat milk", "oat cookies recipe", "call the bank"]:
+        client.post("/write_note", data={"text_note_to_take": note})
+
+    response = client.get("/search?q=oat")
+    assert response.status_code == 200
+    assert b"buy oat milk" in response.data and b"oat cookies recipe" in response.data
+    assert b"call the bank" not in response.data
+    assert b"per_page=1" in client.get("/search?q=oat&per_page=1").data  # kept in "More results"
+    # Query syntax is treated as plain words.
+    assert client.get('/search?q="oat" OR NEAR(').status_code == 200
+
+    from database import search_notes, read_note_from_db, delete_note_from_db
+    assert [x[2] for x in search_notes(test_user[0], "cookies oat")] == ["oat cookies recipe"]
+    delete_note_from_db([x for x in read_note_from_db(test_user[0]) if x[2] == "oat cookies recipe"][0][0])
+    assert search_notes(test_user[0], "cookies") == []
+
+def test_search_requires_login(client):
+    assert client.get("/search?q=x").status_code == 401
+
+def test_benchmark_percentiles():
+    from benchmark import percentile, png
+    values = list(range(1, 101))
+    assert (percentile(values, 50), percentile(values, 95), percentile(values, 99)) == (50, 95, 99)
+    assert percentile([], 50) is None
+    assert png().startswith(b"\x89PNG") and png() != png()
+
+def test_api_requires_token(client):
+    assert client.get("/api/notes").status_code == 401
+    assert client.get("/api/notes", headers={"Authorization": "Bearer nope"}).status_code == 401
+
+def test_api_batch_notes(client, test_user):
+    import json
+    import time
+    from database import create_api_token, count_notes
+    headers = {"Authorization": "Bearer " + create_api_token(test_user[0])}
+    notes = [f"imported note {i}" for i in range(10000)]
+    start = time.perf_counter()
+    response = client.post("/api/notes", json={"notes": notes}, headers=headers)
+    assert response.status_code == 201 and len(response.get_json()["note_ids"]) == 10000
+    assert time.perf_counter() - start < 10
+    assert count_notes(test_user[0]) == 10000
+
+    listed = json.loads(client.get("/api/notes", headers=headers).get_data())
+    assert [x["note"] for x in listed] == notes
+    assert client.post("/api/notes", json={"notes": [1]}, headers=headers).status_code == 400
+
+def test_api_batch_images_and_token_revocation(client, test_user):
+    import json
+    from database import create_api_token, list_api_tokens
+    token = create_api_token(test_user[0])
+    headers = {"Authorization": "Bearer " + token}
+    files = [(io.BytesIO(b"api-image-%d" % i), f"api{i}.png") for i in range(3)]
+    response = client.post("/api/images", data={"file": files}, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 201
+    uids = [x["uid"] for x in response.get_json()["images"]]
+    listed = json.loads(client.get("/api/images", headers=headers).get_data())
+    assert {x["uid"] for x in listed} >= set(uids)
+
+    assert client.get(listed[0]["url"], headers=headers).data.startswith(b"api-image-")
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    token_hash = list_api_tokens(test_user[0])[-1][0]
+    client.get(f"/delete_api_token/{token_hash}")
+    assert client.get("/api/images", headers=headers).status_code == 401
+
+def test_api_list_images_streams_after_the_request(test_user):
+    # Outside `with test_client()` the request context is gone while the body is read, as under gunicorn.
+    import json
+    from database import create_api_token
+    headers = {"Authorization": "Bearer " + create_api_token(test_user[0])}
+    client = flask_app.test_client()
+    client.post("/api/images", data={"file": [(io.BytesIO(b"api-image-streamed"), "streamed.png")]},
+                headers=headers, content_type="multipart/form-data")
+    listed = json.loads(client.get("/api/images", headers=headers).get_data())
+    assert [x["url"] for x in listed] == [f"/image/{x['uid']}" for x in listed]
+
+def test_api_token_revocation_reaches_another_worker(client, test_user):
+    import database
+    from database import create_api_token, list_api_tokens, delete_api_token
+    assert not database._token_cache.enabled  # no shared backend configured
+    headers = {"Authorization": "Bearer " + create_api_token(test_user[0])}
+    assert client.get("/api/notes", headers=headers).status_code == 200
+    pid = os.fork()
+    if pid == 0:
+        try:
+            delete_api_token(test_user[0], list_api_tokens(test_user[0])[-1][0])
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert client.get("/api/notes", headers=headers).status_code == 401
+
+def test_api_token_cache_invalidated_on_user_delete(test_user, monkeypatch):
+    import database
+    from cache import UserDataCache, MemoryBackend
+    from database import create_api_token, api_token_user, delete_user_from_db
+    monkeypatch.setattr(database, "_token_cache", UserDataCache("tokens", ttl=30, backend=MemoryBackend()))
+    token = create_api_token(test_user[0])
+    assert api_token_user(token) == test_user[0]
+    delete_user_from_db(test_user[0])
+    assert api_token_user(token) is None
+
+def test_bulk_import_and_export_users(client, admin_user):
+    from database import verify, delete_user_from_db
+    csv_data = b"id,password\nbulk1,pw1\nbulk2,pw2\nbad id,pw\nADMIN,x\nbulk1,pw1b\n"
+    client.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+    response = client.post("/admin/import_users", data={"file": (io.BytesIO(csv_data), "users.csv")},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b"Imported 3 users, rejected 2" in response.data
+    assert verify("BULK1", "pw1b") and verify("BULK2", "pw2") and verify("ADMIN", admin_user[1])
+
+    exported = client.get("/admin/export_users")
+    assert exported.mimetype == "text/csv"
+    lines = exported.get_data(as_text=True).splitlines()
+    assert lines[0] == "id" and {"BULK1", "BULK2", "ADMIN"} <= set(lines[1:])
+    for id in ["BULK1", "BULK2"]:
+        delete_user_from_db(id)
+
+def test_bulk_import_requires_admin(client, test_user):
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    assert client.get("/admin/export_users").status_code == 401
+
+def test_export_streams_zip(client, test_user):
+    import json
+    import zipfile
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.post("/write_note", data={"text_note_to_take": "exported note"})
+    client.post("/upload_image", data={"file": (io.BytesIO(b"exported-image"), "exp.png")}, content_type='multipart/form-data')
+
+    response = client.get("/export")
+    assert response.mimetype == "application/zip" and response.is_streamed
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    notes = [json.loads(x) for x in archive.read("notes.ndjson").decode().splitlines()]
+    assert [x["note"] for x in notes] == ["exported note"]
+    images = [x for x in archive.namelist() if x.startswith("images/")]
+    assert len(images) == 1 and images[0].endswith("-exp.png")
+    assert archive.read(images[0]) == b"exported-image"
+
+def test_admin_export(client, admin_user, test_user):
+    client.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+    assert client.get(f"/admin/export/{test_user[0]}").mimetype == "application/zip"
+    assert client.get("/admin/export/NOSUCHUSER").status_code == 404
+
+def test_fingerprinted_static_assets(client):
+    import gzip
+    import shutil
+    import assets
+    from flask import url_for
+    assets.build(flask_app.static_folder)
+    assets.load_manifest(flask_app)
+    try:
+        with flask_app.test_request_context():
+            url = url_for("static", filename="css/bootstrap.min.css")
+            layout_css = url_for("static", filename="css/bootstrap.min.united.css")
+        assert url.startswith("/static/_build/css/bootstrap.min.") and url.endswith(".css")
+        assert layout_css.encode() in client.get("/").data
+
+        original = open(os.path.join(flask_app.static_folder, "css/bootstrap.min.css"), "rb").read()
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "immutable" in response.headers["Cache-Control"] and "Accept-Encoding" in response.headers["Vary"]
+        assert gzip.decompress(response.get_data()) == original
+        response = client.get(url)
+        assert "Content-Encoding" not in response.headers and response.get_data() == original
+    finally:
+        shutil.rmtree(os.path.join(flask_app.static_folder, assets.BUILD_DIR))
+        assets.load_manifest(flask_app)
+
+def test_gunicorn_worker_sizing(tmp_path, monkeypatch):
+    monkeypatch.setenv("GUNICORN_PRELOAD", "false")
+    import gunicorn_conf
+    (tmp_path / "cpu.max").write_text("50000 100000\n")
+    (tmp_path / "memory.max").write_text("268435456\n")
+    assert gunicorn_conf.cpu_limit(str(tmp_path)) == 0.5
+    assert gunicorn_conf.memory_limit(str(tmp_path)) == 256 * 2 ** 20
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    (tmp_path / "memory.max").write_text("max\n")
+    assert gunicorn_conf.cpu_limit(str(tmp_path)) is None and gunicorn_conf.memory_limit(str(tmp_path)) is None
+
+    (tmp_path / "cpu.max").unlink()
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("200000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert gunicorn_conf.cpu_limit(str(tmp_path)) == 2
+
+    assert gunicorn_conf.default_workers(0.5, 256 * 2 ** 20, 80) == 2
+    assert gunicorn_conf.default_workers(4, None, 80) == 8
+    assert gunicorn_conf.default_workers(4, 128 * 2 ** 20, 80) == 1
+
+def test_health_and_readiness(client, monkeypatch):
+    import health
+    assert client.get("/healthz").status_code == 200
+    monkeypatch.setattr(health, "_ready", None)
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.get_json()["checks"] == {"database": "ok", "upload_folder": "ok"}
+    assert health._warm_pid == os.getpid()
+
+    # Results are reused for READY_CACHE_TTL seconds.
+    monkeypatch.setitem(flask_app.config, "UPLOAD_FOLDER", "/nonexistent/image_pool")
+    assert client.get("/readyz").status_code == 200
+    monkeypatch.setattr(health, "_ready", None)
+    response = client.get("/readyz")
+    assert response.status_code == 503 and response.get_json()["checks"]["upload_folder"] == "failed"
+
+def test_server_side_session_revoked_with_user(client, admin_user, test_user):
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    cookie = next(x for x in client.cookie_jar if x.name == flask_app.session_cookie_name)
+    assert test_user[0] not in cookie.value and "." not in cookie.value  # an id, not signed data
+    assert client.get("/private/").status_code == 200
+
+    with flask_app.test_client() as admin:
+        admin.post("/login", data={"id": admin_user[0], "pw": admin_user[1]})
+        admin.get(f"/delete_user/{test_user[0]}/")
+    response = client.get("/private/", follow_redirects=True)
+    assert b"401" in response.data or response.status_code == 401
+
+def test_ownership_is_remembered(monkeypatch):
+    import sessions
+    lookups = []
+    def lookup(note_id):
+        lookups.append(note_id)
+        return {"n1": "ALICE"}.get(note_id)
+    monkeypatch.setattr(sessions, "_owned", sessions.TTLCache(maxsize=10, ttl=60))
+    assert sessions.owns("ALICE", "note", "n1", lookup) and sessions.owns("ALICE", "note", "n1", lookup)
+    assert lookups == ["n1"]
+    assert not sessions.owns("BOB", "note", "n1", lookup) and not sessions.owns("BOB", "note", "n1", lookup)
+    assert not sessions.owns(None, "note", "n1", lookup)
+    assert lookups == ["n1", "n1", "n1"]
+    sessions.remember("ALICE", "note", "n2")
+    assert sessions.owns("ALICE", "note", "n2", lookup)
+    sessions.forget("ALICE", "note", "n1")
+    assert sessions.owns("ALICE", "note", "n1", lookup) and lookups[-1] == "n1" and len(lookups) == 4
+
+def test_key_value_session_store():
+    import sessions
+    from cache import MemoryBackend
+    store = sessions.KeyValueStore(MemoryBackend())
+    store.save("h1", "ALICE", "{}", 60)
+    store.save("h2", None, "{}", 60)
+    assert store.load("h1") == ("ALICE", "{}")
+    store.revoke_user("ALICE")
+    assert store.load("h1") is None and store.load("h2") == (None, "{}")
+    store.save("h3", "ALICE", "{}", 60)
+    assert store.load("h3") == ("ALICE", "{}")
+    store.delete("h3")
+    assert store.load("h3") is None
+
+def test_profiling_middleware(client, test_user, tmp_path, monkeypatch):
+    import json
+    import glob
+    import profiling
+    monkeypatch.setattr(flask_app, "wsgi_app", profiling.ProfilingMiddleware(flask_app.wsgi_app, token="secret", directory=str(tmp_path)))
+    monkeypatch.setattr(flask_app.jinja_env, "template_class", profiling.TracedTemplate)
+    flask_app.jinja_env.cache.clear()
+    try:
+        client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+        client.post("/upload_image", data={"file": (io.BytesIO(b"profiled"), "p.png")}, content_type='multipart/form-data',
+                    headers={"X-Profile": "secret"}, buffered=True)
+        response = client.get("/private/", headers={"X-Profile": "secret"}, buffered=True)
+        assert "query;dur=" in response.headers["Server-Timing"]
+        assert "Server-Timing" not in client.get("/private/", headers={"X-Profile": "wrong"}).headers
+
+        reports = {json.load(open(x))["path"]: json.load(open(x)) for x in glob.glob(str(tmp_path / "*.json"))}
+        assert set(reports) == {"/upload_image", "/private/"} and len(glob.glob(str(tmp_path / "*.prof"))) == 2
+        kinds = lambda path: {x["kind"] for x in reports[path]["spans"]}
+        assert {"connect", "query", "file"} <= kinds("/upload_image")
+        assert {"connect", "query", "template"} <= kinds("/private/")
+        assert any(x["detail"] == "private_page.html" for x in reports["/private/"]["spans"])
+    finally:
+        flask_app.jinja_env.cache.clear()
+
+def test_repeated_queries_are_flagged():
+    import profiling
+    trace = profiling.Trace("GET", "/")
+    for i in range(5):
+        trace.query("SELECT owner FROM images\n  WHERE uid = ?", 0, 0.001)
+    trace.query("SELECT 1", 0, 0.001)
+    assert trace.repeated(5) == [("SELECT owner FROM images WHERE uid = ?", 5)]
+
+def test_private_page_shows_api_tokens_once(client, test_user):
+    client.post("/login", data={"id": test_user[0], "pw": test_user[1]})
+    client.post("/api_token")
+    page = client.get("/private/").data
+    assert page.count(b"Create API Token") == 1 and page.count(b"<h3>API Tokens</h3>") == 1
+    assert b"<h1>Private Page</h1>" in page
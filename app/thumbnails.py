@@ -0,0 +1,120 @@
+import os
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+from config import get_config
+from database import set_image_variants, list_images_without_variants
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: uploads still work, just without previews.
+    Image = None
+
+# Variants are generated in the background after an upload: a small "thumb" for
+# the image list and a "medium" preview, both stored next to the original blob.
+# Generation is idempotent, so running it again for the same image (a duplicate
+# upload, a retried job or the backfill) only fills in what is missing.
+
+logger = logging.getLogger("thumbnails")
+
+_config = get_config()
+VARIANT_WIDTHS = {"thumb": _config.THUMBNAIL_WIDTH, "medium": _config.MEDIUM_WIDTH}
+FORMAT_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _variant_format():
+    variant_format = _config.VARIANT_FORMAT.upper()
+    return variant_format, FORMAT_EXTENSIONS[variant_format]
+
+def _render(img, width, full_path, variant_format):
+    resized = img.copy()
+    # thumbnail() keeps the aspect ratio and never upscales.
+    resized.thumbnail((width, width * 4), Image.LANCZOS)
+    if variant_format == "JPEG" and resized.mode not in ("RGB", "L"):
+        resized = resized.convert("RGB")
+    # Write to a temp file and rename, so readers never see half-written variants.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path))
+    try:
+        with os.fdopen(fd, "wb") as out:
+            resized.save(out, variant_format, quality=_config.VARIANT_QUALITY)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, full_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def generate_variants(root, image_uid, name, path):
+    if Image is None:
+        return None
+    variant_format, extension = _variant_format()
+    key = storage.blob_key(image_uid, path)
+    variant_paths = {variant: storage.variant_path(key, variant, extension) for variant in VARIANT_WIDTHS}
+    missing = [v for v, p in variant_paths.items() if not os.path.exists(storage.absolute_path(root, p))]
+    if missing:
+        source = storage.absolute_path(root, path or storage.legacy_path(image_uid, name))
+        os.makedirs(os.path.dirname(storage.absolute_path(root, variant_paths[missing[0]])), exist_ok=True)
+        with Image.open(source) as img:
+            # Let the JPEG decoder downscale while decoding; much cheaper for large photos.
+            img.draft("RGB", (max(VARIANT_WIDTHS.values()),) * 2)
+            img = ImageOps.exif_transpose(img)
+            for variant in missing:
+                _render(img, VARIANT_WIDTHS[variant], storage.absolute_path(root, variant_paths[variant]), variant_format)
+    set_image_variants(image_uid, variant_paths["thumb"], variant_paths["medium"])
+    return variant_paths
+
+def _run(root, image_uid, name, path):
+    try:
+        generate_variants(root, image_uid, name, path)
+    except Exception:
+        logger.warning("Could not generate variants for %s", image_uid, exc_info=True)
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # A pool inherited through fork() has no threads left, start a new one.
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=_config.THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+            _executor_pid = os.getpid()
+    return _executor
+
+def submit(root, image_uid, name, path):
+    if Image is None:
+        return None
+    if _config.THUMBNAIL_WORKERS <= 0:
+        return _run(root, image_uid, name, path)
+    return _get_executor().submit(_run, root, image_uid, name, path)
+
+def backfill(root, workers=4, batch_size=500):
+    # Generates variants for every image that has none yet, e.g. the existing pool.
+    done = 0
+    after = ""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list_images_without_variants(after, batch_size)
+            if not batch:
+                break
+            list(executor.map(lambda x: _run(root, *x), batch))
+            done += len(batch)
+            after = batch[-1][0]
+    return done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thumbnail and preview generation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="generate missing variants for the existing image pool")
+    backfill_parser.add_argument("--root", default=_config.UPLOAD_FOLDER)
+    backfill_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if Image is None:
+        raise SystemExit("Pillow is not installed")
+    from schema import upgrade
+    upgrade()
+    print(f"Processed {backfill(args.root, workers=args.workers)} images")